@@ -23,8 +23,9 @@ from django.contrib.admin import helpers
 from django.contrib import messages
 from django.shortcuts import redirect
 from django.template import RequestContext
-from standin.models import SchoolYear, Plan, Teacher, Subject, Division, Grade
+from standin.models import SchoolYear, Plan, PlanJob, Teacher, Subject, Division, Grade
 from standin.forms import PlanUploadForm
+from standin import ingest
 from django.utils.translation import ugettext as _
 
 @admin.register(Plan)
@@ -33,7 +34,7 @@ class PlanAdmin(admin.ModelAdmin):
 
 	But to add something, only upload is allowed!
 	"""
-	list_display = ('vpdtup', 'vpstand')
+	list_display = ('vpdtup', 'vpstand', 'vpactive', 'getParseSeconds', 'getParseQueries', 'getParseRows', 'getPeakMemory')
 
 	def add_view(self, request):
 		context = RequestContext(request)
@@ -44,15 +45,24 @@ class PlanAdmin(admin.ModelAdmin):
 		if request.POST:
 			form = PlanUploadForm(request.POST, request.FILES)
 			if form.is_valid():
-				form.save()
-				# Add feedback for the user and return to the newsletter
-				# overview page
+				job = form.save()
+				if job is None:
+					# Add feedback for the user and return to the newsletter
+					# overview page
+					messages.add_message(
+						request,
+						messages.SUCCESS,
+						_('Plan uploaded.')
+						)
+					return redirect('admin:standin_plan_changelist')
+
+				# the plan is parsed in the background, show the progress.
 				messages.add_message(
 					request,
 					messages.SUCCESS,
-					_('Plan uploaded.')
+					_('Plan uploaded. It will be processed in the background.')
 					)
-				return redirect('admin:standin_plan_changelist')
+				return redirect('admin:standin_planjob_changelist')
 		else:
 			form = PlanUploadForm()
 
@@ -80,6 +90,29 @@ class PlanAdmin(admin.ModelAdmin):
 		)
 		return self.render_change_form(request, context, add=True, change=False, obj=None)
 
+@admin.register(PlanJob)
+class PlanJobAdmin(admin.ModelAdmin):
+	"""Shows the uploaded plans and the progress of their processing.
+
+	Uploads are added through the plan admin.
+	"""
+	list_display = ('created', 'name', 'status', 'getProgress', 'getDuration', 'plan', 'error')
+	list_filter = ('status',)
+	readonly_fields = ('name', 'status', 'created', 'started', 'finished', 'stage', 'progress', 'error', 'plan')
+	exclude = ('planFile',)
+
+	def getProgress(self, obj):
+		stage, percent, rows = ingest.getProgress(obj)
+		if not stage:
+			return '-'
+		if rows:
+			return '%s (%d%%, %d rows)' % (stage, percent, rows)
+		return '%s (%d%%)' % (stage, percent)
+	getProgress.short_description = _('Progress')
+
+	def has_add_permission(self, request):
+		return False
+
 @admin.register(SchoolYear)
 class SchoolYearAdmin(admin.ModelAdmin):
 	"""Creates admin interface for maintaining school years.
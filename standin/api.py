@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8:ts=8:sw=8:si:sta:noet
+#
+# Standin plan as extension to Django framework.
+# Copyright (C) 2016 Friedrich-List-Schule Wiesbaden
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the 
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from standin.helpers import ENTRY_TYPES, PlanEntryGroup
+import json
+
+# Names of the entry types (vptype flags) in the API.
+FLAG_NAMES = tuple(name.lower() for name in ENTRY_TYPES)
+
+class PlanSerializer:
+	"""Serializes a plan (PlanIterer) to a compact dictionary.
+
+	Teachers, subjects and classes are listed once in the reference tables
+	t, s and g; the entries refer to them by their position. Empty values
+	are left out.
+	"""
+
+	VERSION = 1
+
+	def __init__(self):
+		self.teachers = []
+		self.subjects = []
+		self.grades = []
+		self._refs = {}
+
+	def ref(self, table, obj, value):
+		"""Returns the position of obj in the given reference table (added if needed)."""
+		key = (id(table), obj.id)
+		pos = self._refs.get(key)
+		if pos is None:
+			pos = len(table)
+			table.append(value)
+			self._refs[key] = pos
+		return pos
+
+	def getTeacher(self, teacher):
+		return self.ref(self.teachers, teacher, [teacher.code, teacher.dspName])
+
+	def getSubject(self, subject):
+		return self.ref(self.subjects, subject, [subject.code, subject.dspName])
+
+	def getGrade(self, grade):
+		return self.ref(self.grades, grade, [grade.code, grade.division.name if grade.division is not None else None])
+
+	@staticmethod
+	def getFlags(vptype):
+		return [name for bit, name in enumerate(FLAG_NAMES) if vptype & (1 << bit)]
+
+	def serializeEntry(self, e):
+		# groups have an hour range, single entries just an hour.
+		if isinstance(e, PlanEntryGroup):
+			entry = {'h': [e.hourFrom, e.hourTo]}
+			supplyHour = (e.supplyHourFrom, e.supplyHourTo)
+		else:
+			entry = {'h': [e.hour, e.hour]}
+			supplyHour = (e.supplyHour, e.supplyHour)
+		if e.course is not None:
+			if e.course.teacher is not None:
+				entry['t'] = self.getTeacher(e.course.teacher)
+			if e.course.subject is not None:
+				entry['s'] = self.getSubject(e.course.subject)
+		if e.room:
+			entry['r'] = e.room
+		if e.supplyTeacher is not None:
+			entry['st'] = self.getTeacher(e.supplyTeacher)
+		if e.supplySubject is not None:
+			entry['ss'] = self.getSubject(e.supplySubject)
+		if e.supplyRoom:
+			entry['sr'] = e.supplyRoom
+		if e.supplyDate is not None:
+			entry['sd'] = e.supplyDate.isoformat()
+		if supplyHour[1] is not None:
+			entry['sh'] = list(supplyHour)
+		if e.note:
+			entry['n'] = e.note
+		flags = self.getFlags(e.vptype)
+		if len(flags) > 0:
+			entry['f'] = flags
+		return entry
+
+	def serialize(self, plan, planEntries):
+		"""Returns the dictionary of the given plan header and its (grouped) entries."""
+		days = []
+		for day in planEntries:
+			grades = []
+			for grade in day:
+				grades.append([self.getGrade(grade.grade), [self.serializeEntry(e) for e in grade]])
+			days.append({'d': day.day.isoformat(), 'g': grades})
+
+		return {
+			'v': self.VERSION,
+			'plan': {'id': plan.pk, 'stand': plan.vpstand.isoformat(), 'up': plan.vpdtup.isoformat()},
+			't': self.teachers,
+			's': self.subjects,
+			'g': self.grades,
+			'days': days,
+		}
+
+def dumps(data):
+	"""Returns the JSON of the data (as compact and stable as possible, utf-8 encoded)."""
+	return json.dumps(data, separators=(',', ':'), sort_keys=True, ensure_ascii=False).encode('utf-8')
@@ -23,3 +23,7 @@ from django.utils.translation import ugettext_lazy as _
 class StandinConfig(AppConfig):
 	name = 'standin'
 	verbose_name = _('Standin Plan')
+
+	def ready(self):
+		# connect the signal receivers.
+		import standin.registry
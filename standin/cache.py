@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8:ts=8:sw=8:si:sta:noet
+#
+# Standin plan as extension to Django framework.
+# Copyright (C) 2016 Friedrich-List-Schule Wiesbaden
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the 
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.translation import get_language, override
+from standin import settings as app_settings
+from standin.helpers import PlanIterer
+from standin.models import Plan
+import hashlib, uuid
+
+# The generation is part of every key. Changing it invalidates all cached plans at once.
+GENERATION_KEY = 'standin:generation'
+
+def getCache():
+	"""Returns the cache configured for the plans."""
+	return caches[app_settings.snapshot().PLAN_CACHE_ALIAS]
+
+def getGeneration():
+	cache = getCache()
+	generation = cache.get(GENERATION_KEY)
+	if generation is None:
+		generation = uuid.uuid4().hex
+		# another process could be faster.
+		if not cache.add(GENERATION_KEY, generation, None):
+			generation = cache.get(GENERATION_KEY, generation)
+	return generation
+
+def invalidate():
+	"""Invalidates all cached plans."""
+	getCache().set(GENERATION_KEY, uuid.uuid4().hex, None)
+
+def getDisplaySettings():
+	"""Returns the settings which change the output of the plans."""
+	settings = app_settings.snapshot()
+	return (
+		bool(settings.PLAN_PUPIL_TEACHER_FULLNAME),
+		bool(settings.PLAN_PUPIL_TEACHER_SHORTCUT),
+		bool(settings.PLAN_PUPIL_SUBJECT_FULLNAME),
+		bool(settings.PLAN_PUPIL_SUBJECT_SHORTCUT),
+	)
+
+def getVariant():
+	"""Returns everything beside the plan which changes the output: the first day
+	of the plan (the days shown change at midnight), the language and the display settings."""
+	return (Plan.getStartDate().isoformat(), get_language(), getDisplaySettings())
+
+def makeKey(kind, plan, days, grades):
+	"""Returns the cache key of a plan (or its rendered version)."""
+	if grades is not None:
+		grades = sorted(str(getattr(g, 'pk', g)) for g in grades)
+	# uploads update the fingerprint or the time stamp (or create a new plan).
+	parts = repr((
+		getGeneration(), plan.pk, plan.fingerprint, plan.vpstand.timestamp(), days, grades, getVariant()
+	))
+	return 'standin:%s:%s' % (kind, hashlib.md5(parts.encode('utf-8')).hexdigest())
+
+def cached(key, create):
+	"""Returns the cached value or creates (and caches) it."""
+	cache = getCache()
+	value = cache.get(key)
+	if value is None:
+		value = create()
+		cache.set(key, value, int(app_settings.snapshot().PLAN_CACHE_TIMEOUT))
+	return value
+
+def getPupilPlan(plan, days=2, grades=None):
+	"""Returns the (cached) pupil plan, see Plan.getPupilPlan."""
+	return cached(makeKey('pupil', plan, days, grades), lambda: plan.getPupilPlan(days, grades))
+
+def getRenderedPupilPlan(plan, render, days=2, grades=None):
+	"""Returns the (cached) output of render(pupilPlan)."""
+	return cached(makeKey('pupil-html', plan, days, grades), lambda: render(getPupilPlan(plan, days, grades)))
+
+def getTeacherPlan(plan, teacher, days=2):
+	"""Returns the (cached) plan of a teacher, see Plan.getTeacherPlan."""
+	return cached(makeKey('teacher:%s' % (teacher.pk,), plan, days, None), lambda: plan.getTeacherPlan(teacher, days))
+
+def getRenderedTeacherPlan(plan, teacher, render, days=2):
+	"""Returns the (cached) output of render(teacherPlan)."""
+	return cached(
+		makeKey('teacher-html:%s' % (teacher.pk,), plan, days, None),
+		lambda: render(getTeacherPlan(plan, teacher, days))
+	)
+
+def buildGradePlans(plan, days=2):
+	"""Splits the pupil plan by class and caches every class on its own.
+
+	Returns a dictionary class code -> pupil plan of the class.
+	"""
+	pupilPlan = getPupilPlan(plan, days)
+	partitions = pupilPlan.partition()
+	values = {makeKey('grade', plan, days, [code]): part for code, part in partitions.items()}
+	# the index tells which classes exist (with or without entries) and the days of the plan.
+	values[makeKey('grades', plan, days, None)] = {
+		'days': pupilPlan.getDays(), 'codes': sorted(set(getSchoolYearGrades()) | set(partitions))
+	}
+	getCache().set_many(values, int(app_settings.snapshot().PLAN_CACHE_TIMEOUT))
+	return partitions
+
+def getSchoolYearGrades():
+	"""Returns the codes of all classes of the current school year."""
+	from standin import registry
+	from standin.models import Grade, SchoolYear
+	try:
+		year = registry.getCurrentSchoolYear()
+	except SchoolYear.DoesNotExist:
+		return []
+	return list(Grade.objects.filter(schoolYear=year).values_list('code', flat=True))
+
+def getGradeCodes(plan, days=2):
+	"""Returns the (cached) codes of all classes of the current school year."""
+	indexKey = makeKey('grades', plan, days, None)
+	index = getCache().get(indexKey)
+	if index is not None:
+		return index['codes']
+	return sorted(set(getSchoolYearGrades()) | set(buildGradePlans(plan, days)))
+
+def getGradePlan(plan, code, days=2):
+	"""Returns the (cached) pupil plan of a single class (the days without entries for unknown classes)."""
+	gradeKey = makeKey('grade', plan, days, [code])
+	indexKey = makeKey('grades', plan, days, None)
+	found = getCache().get_many([gradeKey, indexKey])
+	if gradeKey in found:
+		return found[gradeKey]
+
+	if indexKey in found:
+		gradePlan = None
+		planDays = found[indexKey]['days']
+	else:
+		partitions = buildGradePlans(plan, days)
+		gradePlan = partitions.get(code)
+		planDays = getPupilPlan(plan, days).getDays()
+	if gradePlan is None:
+		gradePlan = PlanIterer.fromDays(planDays)
+	return gradePlan
+
+def getRenderedGradePlan(plan, code, render, days=2):
+	"""Returns the (cached) output of render(gradePlan)."""
+	return cached(makeKey('grade-html', plan, days, [code]), lambda: render(getGradePlan(plan, code, days)))
+
+def prewarm(plan):
+	"""Fills the cache with the pupil plan and the plans of every class of the given
+	plan (and their rendered pages). Used after a plan is uploaded.
+	"""
+	from standin.views import renderPlan
+	render = lambda entries: renderPlan(plan, entries)
+	# the pages are rendered (and cached) in the default language of the site.
+	with override(settings.LANGUAGE_CODE):
+		for code in buildGradePlans(plan):
+			getRenderedGradePlan(plan, code, render)
+		getRenderedPupilPlan(plan, render)
@@ -20,7 +20,7 @@
 from django import forms
 from django.utils.translation import ugettext_lazy as _
 from standin import settings as app_settings
-import importlib, gzip
+from standin import ingest
 
 class PlanUploadForm(forms.Form):
 	"""Creates admin form to upload a plan manually.
@@ -31,22 +31,13 @@ class PlanUploadForm(forms.Form):
 	plan = forms.FileField(required=True, label=_('Upload plan'))
 
 	def save(self):
-		# we need to find a parser for the file!
-		mod = app_settings.get(app_settings.PLAN_PARSER_MODEL)
-		if mod is None:
-			raise Exception('Parser is not defined in settings!')
-
-		mod, parser = mod.rsplit('.', 1)
-		mod = importlib.import_module(mod)
-		mod = getattr(mod, parser)
-		# is it gzip compressed?
-		if self.cleaned_data['plan'].name.endswith('.gz'):
-			planFile = gzip.GzipFile(fileobj=self.cleaned_data['plan'].file)
-		else:
-			planFile = self.cleaned_data['plan'].file
-
-		parser = mod(planFile)
-		parser.parse()
-		# remove uploaded file
-		self.cleaned_data['plan'].file.close()
-
+		"""Queues the uploaded plan (or parses it at once). Returns the job or None."""
+		upload = self.cleaned_data['plan']
+		try:
+			if app_settings.snapshot().PLAN_INGEST_MODE == 'sync':
+				ingest.parsePlan(upload.file, upload.name, upload.size)
+				return None
+			return ingest.enqueue(upload)
+		finally:
+			# remove uploaded file
+			upload.file.close()
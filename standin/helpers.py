@@ -17,31 +17,104 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import OrderedDict, namedtuple
+
+# Types of a plan entry (flags of PlanEntry.vptype, in order of their bits).
+ENTRY_TYPES = (
+	#'UNKNOWN', # 0
+	'CANCELLED', # 1
+	'ROOM', # 2
+	'TEACHER', # 4
+	'SUBJECT', # 8
+	'DATETIME', # 16
+	'MOVED_FROM', # 32
+	'MOVED_TO', # 64
+	'FREE', # 128
+	'DUTY' # 256
+)
+
+def entryTypeMask(name):
+	"""Returns the bit mask of the given entry type."""
+	return 1 << ENTRY_TYPES.index(name)
+
+# Lightweight references used by the plan rows (instead of model instances).
+TeacherRef = namedtuple('TeacherRef', ('id', 'code', 'dspName'))
+SubjectRef = namedtuple('SubjectRef', ('id', 'code', 'dspName'))
+DivisionRef = namedtuple('DivisionRef', ('id', 'name'))
+GradeRef = namedtuple('GradeRef', ('id', 'code', 'division'))
+CourseRef = namedtuple('CourseRef', ('id', 'teacher', 'subject'))
+
+class PlanRow(namedtuple('PlanRow', (
+	'id', 'header_id', 'day', 'hour', 'timeStart', 'timeEnd', 'grade_id', 'grade', 'course_id', 'course',
+	'room', 'supplyTeacher_id', 'supplyTeacher', 'supplySubject_id', 'supplySubject', 'supplyRoom',
+	'supplyDate', 'supplyHour', 'supplyTimeStart', 'supplyTimeEnd', 'note', 'vptype'
+))):
+	"""A plan entry as needed for displaying it (see Plan.getPupilRows).
+
+	Offers the same interface as PlanEntry for templates and groupEntries.
+	"""
+
+	__slots__ = ()
+
+	CANCELLED = entryTypeMask('CANCELLED')
+	FREE = entryTypeMask('FREE')
+	MOVED_FROM = entryTypeMask('MOVED_FROM')
+	MOVED_TO = entryTypeMask('MOVED_TO')
+
+	def getGroupKey(self):
+		return (
+			self.header_id, self.day, self.grade_id, self.course_id, self.room,
+			self.supplyTeacher_id, self.supplySubject_id, self.supplyRoom, self.supplyDate,
+			self.supplyHour, self.supplyTimeStart, self.supplyTimeEnd, self.note, self.vptype
+		)
+
+	@property
+	def isCancelled(self):
+		return (self.vptype & self.CANCELLED) != 0
+
+	@property
+	def isFree(self):
+		return (self.vptype & self.FREE) != 0
+
+	@property
+	def isMovedFrom(self):
+		return (self.vptype & self.MOVED_FROM) != 0
+
+	@property
+	def isMovedTo(self):
+		return (self.vptype & self.MOVED_TO) != 0
+
+	def getHour(self):
+		return '%d.' % (self.hour,)
+
+	def getSupplyHour(self):
+		if self.supplyHour is None:
+			return ''
+		return '%d.' % (self.supplyHour,)
+
 class PlanDay:
+	"""All entries of a day, bucketed by grade (in order of appearance)."""
+
+	__slots__ = ('day', '_grades')
 
 	def __init__(self, day):
 		self.day = day
-		self._grades = []
+		self._grades = OrderedDict()
 
 	def addEntry(self, entry):
-		found = False
-		for g in self._grades:
-			if g.grade == entry.grade:
-				g.addEntry(entry)
-				found = True
-				break
-
-		if found is False:
+		grade = self._grades.get(entry.grade_id)
+		if grade is None:
 			grade = PlanGrade(entry.grade)
-			grade.addEntry(entry)
-			self._grades.append(grade)
+			self._grades[entry.grade_id] = grade
+		grade.addEntry(entry)
 
 	def __iter__(self):
-		for d in self._grades:
-			yield d
+		return iter(self._grades.values())
 
 class PlanGrade:
 
+	__slots__ = ('grade', '_entries')
+
 	def __init__(self, grade):
 		self.grade = grade
 		self._entries = []
@@ -50,14 +123,15 @@ class PlanGrade:
 		self._entries.append(entry)
 
 	def __iter__(self):
-		for d in self._entries:
-			yield d
+		return iter(self._entries)
 
 class PlanIterer:
 	"""Class to easily iterate in views."""
 
+	__slots__ = ('_days',)
+
 	def __init__(self):
-		self._days = []
+		self._days = OrderedDict()
 
 	def addEntry(self, entry):
 		day = self.findDay(entry.day)
@@ -65,65 +139,116 @@ class PlanIterer:
 			day.addEntry(entry)
 
 	def findDay(self, entryDay):
-		for d in self._days:
-			if d.day == entryDay:
-				return d
-		return None
+		return self._days.get(entryDay)
 
 	def addDay(self, day):
-		self._days.append(PlanDay(day))
+		if day not in self._days:
+			self._days[day] = PlanDay(day)
+
+	def getDays(self):
+		return list(self._days.keys())
+
+	@staticmethod
+	def fromDays(days):
+		"""Returns a plan with the given days (but without entries)."""
+		plan = PlanIterer()
+		for day in days:
+			plan.addDay(day)
+		return plan
+
+	def partition(self):
+		"""Splits the plan by grade. Returns a dictionary grade code -> PlanIterer (with all days)."""
+		partitions = {}
+		for day in self:
+			for grade in day:
+				part = partitions.get(grade.grade.code)
+				if part is None:
+					part = PlanIterer.fromDays(self._days)
+					partitions[grade.grade.code] = part
+				part._days[day.day]._grades[grade.grade.id] = grade
+		return partitions
 
 	def __iter__(self):
-		for d in self._days:
-			yield d
+		return iter(self._days.values())
 
 class PlanEntryGroup:
 	"""This class groups multiple entries which are similiar to each other and where
-	e.g. only the hour / start or end time is different."""
-
-	def __init__(self, base):
-		self._base = base
+	e.g. only the hour / start or end time is different.
 
-	@classmethod
-	def createGroup(group, entry, nextEntry):
-		group = PlanEntryGroup(entry)
-		for attr in entry.__dict__:
-			if attr not in ['id', 'hour', 'timeStart', 'timeEnd']:
-				setattr(group, attr, getattr(entry, attr))
-		group._entries = [entry, nextEntry]
-		return group
+	The hour range is kept up to date while entries are added, all other
+	values are taken from the first entry."""
 
-	def __getattr__(self, name):
-		# for hours, we return always the highest!
-		if name == 'hour':
-			return self.maxHour()
+	__slots__ = ('entries', 'hourFrom', 'hourTo', 'supplyHourFrom', 'supplyHourTo')
 
-		if hasattr(self._base, name):
-			return getattr(self._base, name)
-		else:
-			return None
+	def __init__(self, entry):
+		self.entries = [entry]
+		self.hourFrom = self.hourTo = entry.hour
+		self.supplyHourFrom = self.supplyHourTo = entry.supplyHour
 
 	def add(self, entry):
-		self._entries.append(entry)
-
-	def maxHour(self):
-		hours = [e.hour for e in self._entries]
-		return max(hours)
+		self.entries.append(entry)
+		self.hourFrom = min(self.hourFrom, entry.hour)
+		self.hourTo = max(self.hourTo, entry.hour)
+		if entry.supplyHour is not None:
+			if self.supplyHourFrom is None:
+				self.supplyHourFrom = self.supplyHourTo = entry.supplyHour
+			else:
+				self.supplyHourFrom = min(self.supplyHourFrom, entry.supplyHour)
+				self.supplyHourTo = max(self.supplyHourTo, entry.supplyHour)
+
+	@property
+	def hour(self):
+		# for hours, we return always the highest!
+		return self.hourTo
 
 	def getHour(self):
-		# min number.
-		hours = [e.hour for e in self._entries]
-		return '%d.-%d.' % (min(hours), max(hours))
+		return '%d.-%d.' % (self.hourFrom, self.hourTo)
 
 	def getSupplyHour(self):
-		# min number.
-		hours = [e.supplyHour for e in self._entries]
-		return '%d.-%d.' % (min(hours), max(hours))
+		if self.supplyHourFrom is None:
+			return ''
+		return '%d.-%d.' % (self.supplyHourFrom, self.supplyHourTo)
 
 	def is_group(self):
 		return True
 
-	def similiar(self, entry):
-		# pick always the last entry!
-		return self._entries[len(self._entries) - 1].similiar(entry)
-
+def _firstEntryAttribute(name):
+	return property(lambda self: getattr(self.entries[0], name))
+
+# Attributes which are equal for all entries of a group.
+for _name in (
+	'header_id', 'day', 'grade', 'grade_id', 'course', 'room', 'supplyTeacher', 'supplySubject',
+	'supplyRoom', 'supplyDate', 'supplyTimeStart', 'supplyTimeEnd', 'note', 'vptype',
+	'isCancelled', 'isFree', 'isMovedFrom', 'isMovedTo'
+):
+	setattr(PlanEntryGroup, _name, _firstEntryAttribute(_name))
+del(_name)
+
+def groupEntries(entries):
+	"""Merges runs of similiar entries in consecutive hours into groups.
+
+	The entries must be ordered by day, grade and hour and must provide
+	getGroupKey() (all values which must be equal beside of the hour).
+	Single entries are returned as they are.
+	"""
+	group = None
+	groupKey = None
+	lastHour = None
+	for e in entries:
+		key = e.getGroupKey()
+		if group is not None and key == groupKey and (e.hour - lastHour) <= 1:
+			if not isinstance(group, PlanEntryGroup):
+				group = PlanEntryGroup(group)
+			group.add(e)
+			lastHour = e.hour
+			continue
+
+		if group is not None:
+			yield group
+		group = e
+		groupKey = key
+		lastHour = e.hour
+
+	# Left entry?
+	if group is not None:
+		yield group
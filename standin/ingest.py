@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8:ts=8:sw=8:si:sta:noet
+#
+# Standin plan as extension to Django framework.
+# Copyright (C) 2016 Friedrich-List-Schule Wiesbaden
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the 
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from standin import settings as app_settings
+from standin import cache
+from standin.models import PlanJob
+import datetime, gzip, importlib, logging, struct, threading, time
+
+logger = logging.getLogger(__name__)
+
+# Key of the progress of a running job. While the plan is parsed, the job row
+# cannot be updated by the parsing thread (the parser writes everything in one
+# transaction). The progress is cached for the own process and written to the
+# job row by the Heartbeat for all others.
+PROGRESS_KEY = 'standin:job:%d'
+# Seconds between two heartbeats of a running job.
+HEARTBEAT_INTERVAL = 10
+
+def getParserClass():
+	"""Returns the parser configured with PLAN_PARSER_MODEL."""
+	mod = app_settings.snapshot().PLAN_PARSER_MODEL
+	if mod is None:
+		raise Exception('Parser is not defined in settings!')
+
+	mod, parser = mod.rsplit('.', 1)
+	mod = importlib.import_module(mod)
+	return getattr(mod, parser)
+
+def getPlanSize(fileobj, name, size):
+	"""Returns the (uncompressed) size of a plan file."""
+	if not name.endswith('.gz'):
+		return size
+
+	# gzip stores the uncompressed size (modulo 2^32) in the last 4 bytes.
+	pos = fileobj.tell()
+	fileobj.seek(-4, 2)
+	size = struct.unpack('<I', fileobj.read(4))[0]
+	fileobj.seek(pos)
+	return size
+
+def parsePlan(fileobj, name, size, progress=None):
+	"""Parses the given plan file with the configured parser and returns the parser."""
+	parserClass = getParserClass()
+	# is it gzip compressed?
+	if name.endswith('.gz'):
+		planFile = gzip.GzipFile(fileobj=fileobj)
+	else:
+		planFile = fileobj
+
+	kwargs = {}
+	if progress is not None:
+		kwargs['progress'] = progress
+	# large files are streamed (if the parser is able to).
+	if getattr(parserClass, 'supportsStreaming', False) \
+		and getPlanSize(fileobj, name, size) > int(app_settings.snapshot().PLAN_STREAMING_THRESHOLD):
+		kwargs['streaming'] = True
+	parser = parserClass(planFile, **kwargs)
+	parser.parse()
+	return parser
+
+def enqueue(upload, digest='', start=True):
+	"""Stores the uploaded file as new job and wakes up the worker thread (if used and start is set)."""
+	job = PlanJob(name=upload.name, digest=digest)
+	job.planFile.save(upload.name, upload, save=False)
+	job.save()
+	if start and app_settings.snapshot().PLAN_INGEST_MODE == 'thread':
+		transaction.on_commit(startWorker)
+	return job
+
+def recoverJobs():
+	"""Fails running jobs without heartbeat for PLAN_INGEST_TIMEOUT seconds.
+
+	Their worker died (e.g. the web server was restarted) and they would
+	block the queue forever. Returns the number of failed jobs.
+	"""
+	now = timezone.now()
+	limit = now - datetime.timedelta(seconds=int(app_settings.snapshot().PLAN_INGEST_TIMEOUT))
+	stale = PlanJob.objects.filter(
+		Q(heartbeat__lt=limit) | Q(heartbeat__isnull=True, started__lt=limit), status=PlanJob.RUNNING
+	)
+	count = stale.update(status=PlanJob.FAILED, finished=now, error='The worker stopped while parsing the plan.')
+	if count > 0:
+		logger.warning('Failed %d plan upload(s) without heartbeat.', count)
+	return count
+
+def claimJob():
+	"""Marks the newest queued job as running and returns it.
+
+	Older queued jobs are skipped, as the newest upload contains the
+	current plan anyway. Returns None if there is nothing to do or another
+	job is still running.
+	"""
+	recoverJobs()
+	with transaction.atomic():
+		if PlanJob.objects.filter(status=PlanJob.RUNNING).exists():
+			return None
+		job = PlanJob.objects.select_for_update().filter(status=PlanJob.QUEUED).order_by('-created', '-id').first()
+		if job is None:
+			return None
+
+		now = timezone.now()
+		for old in PlanJob.objects.filter(status=PlanJob.QUEUED).exclude(pk=job.pk):
+			old.status = PlanJob.SKIPPED
+			old.finished = now
+			old.error = 'Superseded by upload %d.' % (job.pk,)
+			old.save()
+			old.planFile.delete(save=True)
+			logger.info('Skipped plan upload %s.', old)
+
+		claimed = PlanJob.objects.filter(pk=job.pk, status=PlanJob.QUEUED).update(
+			status=PlanJob.RUNNING, started=now, heartbeat=now
+		)
+		if claimed == 0:
+			return None
+		job.status = PlanJob.RUNNING
+		job.started = job.heartbeat = now
+	return job
+
+class Heartbeat(threading.Thread):
+	"""Writes the progress of a running job to its row regularly.
+
+	The thread has a database connection of its own, so the row is updated
+	outside of the transaction of the parser. Jobs without heartbeat are
+	failed by recoverJobs().
+	"""
+
+	def __init__(self, job, interval=HEARTBEAT_INTERVAL):
+		super().__init__(name='standin-heartbeat', daemon=True)
+		self.job = job
+		self.interval = interval
+		self.stage = ''
+		self.progress = 0
+		self._done = threading.Event()
+
+	def run(self):
+		try:
+			while not self._done.wait(self.interval):
+				self.beat()
+		finally:
+			connection.close()
+
+	def beat(self):
+		try:
+			PlanJob.objects.filter(pk=self.job.pk, status=PlanJob.RUNNING).update(
+				heartbeat=timezone.now(), stage=self.stage, progress=self.progress
+			)
+		except DatabaseError:
+			# e.g. SQLite, which is locked while the plan is written.
+			logger.debug('Heartbeat of plan upload %s failed.', self.job, exc_info=True)
+
+	def stop(self):
+		self._done.set()
+		self.join()
+
+def runJob(job):
+	"""Parses the plan of a claimed job and stores the result."""
+	parserClass = getParserClass()
+	stages = list(getattr(parserClass, 'STAGES', ()))
+	key = PROGRESS_KEY % (job.pk,)
+	heartbeat = Heartbeat(job)
+
+	def progress(stage):
+		percent = 0
+		if stage.name in stages:
+			percent = int(100 * stages.index(stage.name) / len(stages))
+		heartbeat.stage = stage.name
+		heartbeat.progress = percent
+		cache.getCache().set(key, (stage.name, percent, stage.rows))
+
+	heartbeat.start()
+	try:
+		job.planFile.open('rb')
+		try:
+			parser = parsePlan(job.planFile.file, job.name, job.planFile.size, progress)
+		finally:
+			job.planFile.close()
+			heartbeat.stop()
+	except Exception as e:
+		logger.exception('Parsing of plan upload %s failed.', job)
+		job.stage = getProgress(job)[0]
+		job.status = PlanJob.FAILED
+		job.error = str(e) or e.__class__.__name__
+	else:
+		job.status = PlanJob.DONE
+		job.plan = parser.plan
+		job.stage = ''
+		job.progress = 100
+		job.planFile.delete(save=False)
+	job.finished = timezone.now()
+	job.save()
+	cache.getCache().delete(key)
+	if job.status == PlanJob.DONE:
+		entries = parser.statistics.stage('write').rows
+		seconds = job.getDuration().total_seconds()
+		logger.info(
+			'Plan upload %s finished after %s (%d entries, %.0f entries/s).', job, job.getDuration(),
+			entries, entries / seconds if seconds > 0 else 0
+		)
+	else:
+		logger.info('Plan upload %s finished after %s.', job, job.getDuration())
+	return job
+
+def processJobs():
+	"""Runs queued jobs until the queue is empty. Returns the number of parsed jobs."""
+	count = 0
+	job = claimJob()
+	while job is not None:
+		runJob(job)
+		count += 1
+		job = claimJob()
+	return count
+
+def getProgress(job):
+	"""Returns stage, percentage and written rows (if known) of the given job."""
+	if job.status == PlanJob.RUNNING:
+		progress = cache.getCache().get(PROGRESS_KEY % (job.pk,))
+		if progress is not None:
+			return progress
+	return (job.stage, job.progress, None)
+
+# The worker thread (one per process) and whether new jobs were queued meanwhile.
+_worker = None
+_wakeup = False
+_lock = threading.Lock()
+
+def startWorker():
+	"""Starts the worker thread (or tells the running one to look for new jobs)."""
+	global _worker, _wakeup
+	with _lock:
+		_wakeup = True
+		if _worker is None:
+			_worker = threading.Thread(target=_work, name='standin-ingest', daemon=True)
+			_worker.start()
+
+def _work():
+	global _worker, _wakeup
+	try:
+		while True:
+			with _lock:
+				if not _wakeup:
+					_worker = None
+					return
+				_wakeup = False
+			try:
+				processJobs()
+				# blocked by a job of another process? Wait until it finished (or died).
+				if PlanJob.objects.filter(status=PlanJob.QUEUED).exists():
+					time.sleep(HEARTBEAT_INTERVAL)
+					with _lock:
+						_wakeup = True
+			except Exception:
+				logger.exception('Processing of plan uploads failed.')
+	finally:
+		connection.close()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8:ts=8:sw=8:si:sta:noet
+#
+# Standin plan as extension to Django framework.
+# Copyright (C) 2016 Friedrich-List-Schule Wiesbaden
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the 
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from standin.models import SchoolYear, Teacher, Subject, Course, Grade, Plan, PlanEntry
+import datetime, time
+
+class Rollback(Exception):
+	pass
+
+class Command(BaseCommand):
+	help = (
+		'Shows the query plans of the pupil plan with and without the plan indexes on a seeded table. '
+		'The seeded rows and the dropped indexes are rolled back at the end, so the database must support '
+		'transactional DDL (e.g. PostgreSQL or SQLite, not MySQL or Oracle). The tables are locked while '
+		'the command runs: use a copy or a throwaway database (--database), not the live one.'
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument('--entries', type=int, default=1000000, help='Number of plan entries to seed.')
+		parser.add_argument('--plans', type=int, default=100, help='Number of plans to spread the entries on.')
+		parser.add_argument(
+			'--database', default=DEFAULT_DB_ALIAS,
+			help='Database (alias of settings.DATABASES) to run the benchmark on (default: "default").'
+		)
+
+	def handle(self, *args, **options):
+		self.db = options['database']
+		connection = connections[self.db]
+		# without transactional DDL, the seeded rows and the dropped indexes would stay.
+		if not connection.features.can_rollback_ddl:
+			raise CommandError(
+				'The database "%s" (%s) cannot roll back schema changes. Run the benchmark on a database '
+				'with transactional DDL.' % (self.db, connection.vendor)
+			)
+
+		# everything happens in a transaction, which is rolled back at the end.
+		try:
+			with transaction.atomic(using=self.db):
+				plan = self.seed(options['entries'], options['plans'])
+				self.stdout.write('== With indexes')
+				self.explain(plan)
+				with connection.schema_editor() as editor:
+					for model in (Plan, PlanEntry):
+						editor.alter_index_together(model, model._meta.index_together, [])
+				self.stdout.write('== Without indexes')
+				self.explain(plan)
+				raise Rollback()
+		except Rollback:
+			pass
+
+	def seed(self, entries, plans):
+		"""Creates the given number of entries (and the needed master data)."""
+		today = datetime.date.today()
+		year = SchoolYear.objects.using(self.db).create(start=today, end=today)
+		teacher = Teacher.objects.using(self.db).create(code='BENCH')
+		subject = Subject.objects.using(self.db).create(code='BENCH', fullname='Benchmark')
+		course = Course.objects.using(self.db).create(schoolYear=year, teacher=teacher, subject=subject, name='BENCH')
+		grades = [Grade(schoolYear=year, code='BENCH%d' % (i,)) for i in range(50)]
+		Grade.objects.using(self.db).bulk_create(grades)
+
+		perPlan = max(1, entries // plans)
+		header = None
+		batch = []
+		for i in range(entries):
+			if i % perPlan == 0:
+				header = Plan.objects.using(self.db).create(vpstand=datetime.datetime.now(), vpactive=True)
+			batch.append(PlanEntry(
+				header=header, day=today + datetime.timedelta(days=(i // 500) % 5), hour=1 + i % 10,
+				timeStart=datetime.time(8), timeEnd=datetime.time(9), grade=grades[(i // 10) % len(grades)],
+				course=course, room='R1', vptype=PlanEntry.vptype.FREE
+			))
+			if len(batch) >= 5000:
+				PlanEntry.objects.using(self.db).bulk_create(batch)
+				batch = []
+		PlanEntry.objects.using(self.db).bulk_create(batch)
+		return header
+
+	def explain(self, plan):
+		days = plan.getNextDays(2, datetime.date.today())
+		queries = (
+			('active plan', Plan.objects.using(self.db).filter(vpactive=True).order_by('-vpdtup')[:1]),
+			('next days', days),
+			('pupil entries', plan.getPupilEntries(days)),
+			('pupil entries of a class', plan.getPupilEntries(days, Grade.objects.using(self.db).filter(code='BENCH1'))),
+		)
+		connection = connections[self.db]
+		prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+		with connection.cursor() as cursor:
+			for name, qs in queries:
+				sql, params = qs.query.sql_with_params()
+				start = time.time()
+				list(qs)
+				duration = time.time() - start
+				cursor.execute(prefix + sql, params)
+				self.stdout.write('-- %s (%.2f ms)' % (name, duration * 1000))
+				for row in cursor.fetchall():
+					self.stdout.write('   ' + ' '.join(str(c) for c in row))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8:ts=8:sw=8:si:sta:noet
+#
+# Standin plan as extension to Django framework.
+# Copyright (C) 2016 Friedrich-List-Schule Wiesbaden
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the 
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+from standin.retention import compactPlans
+
+class Command(BaseCommand):
+	help = 'Deletes superseded standin plans and their entries.'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--keep', type=int, default=None,
+			help='Number of most recent plans to keep (default: PLAN_RETENTION_KEEP).'
+		)
+		parser.add_argument(
+			'--daily', action='store_true', default=False,
+			help='Keep additionally the most recent plan of every day.'
+		)
+		parser.add_argument(
+			'--batch-size', type=int, default=None,
+			help='Number of rows deleted at once (default: PLAN_BULK_BATCH_SIZE).'
+		)
+
+	def handle(self, *args, **options):
+		report = compactPlans(keep=options['keep'], keepDaily=options['daily'], batchSize=options['batch_size'])
+		self.stdout.write(str(report))
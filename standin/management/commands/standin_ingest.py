@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8:ts=8:sw=8:si:sta:noet
+#
+# Standin plan as extension to Django framework.
+# Copyright (C) 2016 Friedrich-List-Schule Wiesbaden
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the 
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+from standin.ingest import processJobs
+import time
+
+class Command(BaseCommand):
+	help = 'Parses queued plan uploads (use PLAN_INGEST_MODE = \'command\').'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--once', action='store_true', default=False,
+			help='Process the queued uploads and exit instead of waiting for new ones.'
+		)
+		parser.add_argument(
+			'--interval', type=float, default=5,
+			help='Seconds to wait before looking for new uploads (default: 5).'
+		)
+
+	def handle(self, *args, **options):
+		while True:
+			count = processJobs()
+			if count > 0:
+				self.stdout.write('Processed %d plan upload(s).' % (count,))
+			if options['once']:
+				break
+			time.sleep(options['interval'])
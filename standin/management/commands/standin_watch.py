@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8:ts=8:sw=8:si:sta:noet
+#
+# Standin plan as extension to Django framework.
+# Copyright (C) 2016 Friedrich-List-Schule Wiesbaden
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the 
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand, CommandError
+from standin.watch import DropFolderWatcher
+import os
+
+class Command(BaseCommand):
+	help = 'Watches a directory and imports the plan files written to it.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('path', help='Directory to watch.')
+		parser.add_argument(
+			'--workers', type=int, default=1,
+			help='Number of files hashed at the same time (default: 1).'
+		)
+		parser.add_argument(
+			'--settle', type=float, default=2,
+			help='Seconds a file must stay unchanged before it is imported (default: 2).'
+		)
+		parser.add_argument(
+			'--interval', type=float, default=5,
+			help='Seconds between two scans of the directory (default: 5).'
+		)
+		parser.add_argument(
+			'--remove', action='store_true', default=False,
+			help='Delete the files after they are imported.'
+		)
+		parser.add_argument(
+			'--poll', action='store_true', default=False,
+			help='Poll the directory even if inotify is available.'
+		)
+		parser.add_argument(
+			'--once', action='store_true', default=False,
+			help='Import the present files and exit.'
+		)
+
+	def handle(self, *args, **options):
+		if not os.path.isdir(options['path']):
+			raise CommandError('%s is not a directory.' % (options['path'],))
+
+		watcher = DropFolderWatcher(
+			options['path'], workers=options['workers'], settle=options['settle'],
+			interval=options['interval'], remove=options['remove'], useInotify=not options['poll']
+		)
+		try:
+			watcher.run(once=options['once'])
+		except KeyboardInterrupt:
+			pass
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
-# Generated by Django 1.9.2 on 2016-02-29 20:22
+# Generated by Django 1.11.29 on 2026-10-17 02:39
 from __future__ import unicode_literals
 
+import bitfield.models
 from django.conf import settings
 from django.db import migrations, models
 import django.db.models.deletion
+import uuid
 
 
 class Migration(migrations.Migration):
@@ -19,7 +21,7 @@ class Migration(migrations.Migration):
         migrations.CreateModel(
             name='Course',
             fields=[
-                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
                 ('name', models.CharField(max_length=15, verbose_name='Course name')),
                 ('groupBy', models.CharField(max_length=15, null=True, verbose_name='Class name')),
             ],
@@ -30,28 +32,43 @@ class Migration(migrations.Migration):
         migrations.CreateModel(
             name='Division',
             fields=[
-                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
                 ('name', models.CharField(max_length=50, unique=True)),
-                ('abbreviation', models.SlugField(max_length=20, null=True)),
+                ('code', models.CharField(max_length=20, null=True)),
             ],
             options={
                 'verbose_name': 'Type of school',
             },
         ),
+        migrations.CreateModel(
+            name='Grade',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('code', models.CharField(max_length=50, verbose_name='Class code')),
+                ('courses', models.ManyToManyField(to='standin.Course')),
+                ('division', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='standin.Division', verbose_name='Division')),
+            ],
+            options={
+                'verbose_name': 'Class',
+                'verbose_name_plural': 'Classes',
+            },
+        ),
         migrations.CreateModel(
             name='Plan',
             fields=[
                 ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
                 ('vpdtup', models.DateTimeField(auto_now_add=True, verbose_name='Upload date and time')),
                 ('vpstand', models.DateTimeField(verbose_name='Date and time of data')),
+                ('vpactive', models.BooleanField(default=False, verbose_name='Active')),
             ],
             options={
                 'verbose_name': 'Standin plan',
                 'ordering': ['vpdtup'],
+                'get_latest_by': 'vpdtup',
             },
         ),
         migrations.CreateModel(
-            name='PlanEntries',
+            name='PlanEntry',
             fields=[
                 ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
                 ('day', models.DateField(verbose_name='Day of standin')),
@@ -64,10 +81,11 @@ class Migration(migrations.Migration):
                 ('supplyHour', models.PositiveSmallIntegerField(null=True, verbose_name='Supply hour')),
                 ('supplyTimeStart', models.TimeField(null=True, verbose_name='Supply time start')),
                 ('supplyTimeEnd', models.TimeField(null=True, verbose_name='Supply time end')),
-                ('note', models.TextField(max_length=550)),
-                ('vptype', models.PositiveSmallIntegerField(verbose_name='Type of standin')),
+                ('note', models.TextField(max_length=550, null=True, verbose_name='Information')),
+                ('vptype', bitfield.models.BitField(('CANCELLED', 'ROOM', 'TEACHER', 'SUBJECT', 'DATETIME', 'MOVED_FROM', 'MOVED_TO', 'FREE', 'DUTY'), default=0)),
                 ('course', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='standin.Course', verbose_name='Affected course')),
-                ('header', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='standin.Plan', verbose_name='Plan header')),
+                ('grade', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='standin.Grade', verbose_name='Affected class')),
+                ('header', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='standin.Plan', verbose_name='Plan header')),
             ],
             options={
                 'verbose_name': 'Standin',
@@ -87,9 +105,9 @@ class Migration(migrations.Migration):
         migrations.CreateModel(
             name='Subject',
             fields=[
-                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
                 ('fullname', models.CharField(max_length=80)),
-                ('abbreviation', models.SlugField(max_length=20, unique=True)),
+                ('code', models.CharField(max_length=20, unique=True)),
             ],
             options={
                 'verbose_name': 'Subject',
@@ -98,28 +116,30 @@ class Migration(migrations.Migration):
         migrations.CreateModel(
             name='Teacher',
             fields=[
-                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
-                ('nickname', models.SlugField(max_length=120, unique=True)),
-                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('first_name', models.CharField(max_length=120, null=True)),
+                ('last_name', models.CharField(max_length=120, null=True)),
+                ('code', models.CharField(max_length=120, null=True, unique=True)),
+                ('user', models.OneToOneField(null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
             ],
             options={
                 'verbose_name': 'Teacher',
             },
         ),
         migrations.AddField(
-            model_name='planentries',
+            model_name='planentry',
             name='supplySubject',
             field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='standin.Subject', verbose_name='Supply teacher'),
         ),
         migrations.AddField(
-            model_name='planentries',
+            model_name='planentry',
             name='supplyTeacher',
             field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='standin.Teacher', verbose_name='Supply teacher'),
         ),
         migrations.AddField(
-            model_name='course',
-            name='division',
-            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='standin.Division', verbose_name='Division'),
+            model_name='grade',
+            name='schoolYear',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='standin.SchoolYear', verbose_name='School year'),
         ),
         migrations.AddField(
             model_name='course',
@@ -134,6 +154,10 @@ class Migration(migrations.Migration):
         migrations.AddField(
             model_name='course',
             name='teacher',
-            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='standin.Teacher', verbose_name='Original teacher'),
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='standin.Teacher', verbose_name='Original teacher'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='grade',
+            unique_together=set([('schoolYear', 'code')]),
         ),
     ]
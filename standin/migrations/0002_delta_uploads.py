@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 02:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('standin', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlanChangelog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Upload date and time')),
+                ('vpstand', models.DateTimeField(verbose_name='Date and time of data')),
+                ('inserted', models.PositiveIntegerField(default=0, verbose_name='Inserted entries')),
+                ('updated', models.PositiveIntegerField(default=0, verbose_name='Updated entries')),
+                ('removed', models.PositiveIntegerField(default=0, verbose_name='Removed entries')),
+                ('changes', models.TextField(default='{}', verbose_name='Changes')),
+                ('header', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changelogs', to='standin.Plan', verbose_name='Plan header')),
+            ],
+            options={
+                'verbose_name': 'Plan changelog',
+                'ordering': ['created'],
+                'get_latest_by': 'created',
+            },
+        ),
+        migrations.AddField(
+            model_name='planentry',
+            name='fingerprint',
+            field=models.CharField(editable=False, max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='planentry',
+            name='lessonKey',
+            field=models.CharField(editable=False, max_length=40, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 02:41
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('standin', '0002_delta_uploads'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='plan',
+            index_together=set([('vpactive', 'vpdtup')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='planentry',
+            index_together=set([('header', 'day', 'grade', 'hour')]),
+        ),
+    ]
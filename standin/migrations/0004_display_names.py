@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 02:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def formatName(code, fullName, showFullName, showCode):
+    if fullName is None or not showFullName:
+        return code
+    if showCode:
+        return '%s (%s)' % (fullName, code)
+    return fullName
+
+
+def storeDisplayNames(apps, schema_editor):
+    # the names are formatted here (and not by the models), so the migration
+    # keeps working if the models change later on.
+    from standin import settings as app_settings
+    settings = app_settings.snapshot()
+    Teacher = apps.get_model('standin', 'Teacher')
+    Subject = apps.get_model('standin', 'Subject')
+    for t in Teacher.objects.select_related('user'):
+        if t.user is not None:
+            fullName = ('%s %s' % (t.user.first_name, t.user.last_name)).strip()
+        elif t.first_name is None or t.last_name is None:
+            fullName = None
+        else:
+            fullName = '%s %s' % (t.first_name, t.last_name)
+        Teacher.objects.filter(pk=t.pk).update(
+            pupilName=formatName(
+                t.code, fullName, settings.PLAN_PUPIL_TEACHER_FULLNAME, settings.PLAN_PUPIL_TEACHER_SHORTCUT
+            ),
+            teacherName=t.code if not fullName else '%s (%s)' % (fullName, t.code),
+        )
+    for s in Subject.objects.all():
+        Subject.objects.filter(pk=s.pk).update(
+            pupilName=formatName(
+                s.code, s.fullname, settings.PLAN_PUPIL_SUBJECT_FULLNAME, settings.PLAN_PUPIL_SUBJECT_SHORTCUT
+            ),
+            teacherName=s.code if not s.fullname else '%s (%s)' % (s.fullname, s.code),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('standin', '0003_plan_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subject',
+            name='pupilName',
+            field=models.CharField(editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='subject',
+            name='teacherName',
+            field=models.CharField(editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='teacher',
+            name='pupilName',
+            field=models.CharField(editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='teacher',
+            name='teacherName',
+            field=models.CharField(editable=False, max_length=255, null=True),
+        ),
+        migrations.RunPython(storeDisplayNames, migrations.RunPython.noop),
+    ]
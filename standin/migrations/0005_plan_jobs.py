@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 02:52
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('standin', '0004_display_names'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlanJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('planFile', models.FileField(null=True, upload_to='standin/uploads/', verbose_name='Plan file')),
+                ('name', models.CharField(max_length=255, verbose_name='File name')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'), ('skipped', 'Skipped')], default='queued', max_length=10, verbose_name='Status')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Upload date and time')),
+                ('started', models.DateTimeField(null=True, verbose_name='Started')),
+                ('finished', models.DateTimeField(null=True, verbose_name='Finished')),
+                ('stage', models.CharField(blank=True, default='', max_length=40, verbose_name='Stage')),
+                ('progress', models.PositiveSmallIntegerField(default=0, verbose_name='Progress')),
+                ('error', models.TextField(blank=True, default='', verbose_name='Error')),
+                ('plan', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='standin.Plan', verbose_name='Plan header')),
+            ],
+            options={
+                'verbose_name': 'Plan upload',
+                'ordering': ['-created'],
+                'get_latest_by': 'created',
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 02:54
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('standin', '0005_plan_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plan',
+            name='fingerprint',
+            field=models.CharField(editable=False, max_length=40, null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 02:56
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('standin', '0006_plan_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plan',
+            name='statistics',
+            field=models.TextField(default='{}', editable=False, verbose_name='Parse statistics'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 02:59
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def deactivateOldPlans(apps, schema_editor):
+    # only the most recent active plan stays active.
+    Plan = apps.get_model('standin', 'Plan')
+    newest = Plan.objects.filter(vpactive=True).order_by('-vpdtup').values_list('id', flat=True).first()
+    if newest is not None:
+        Plan.objects.filter(vpactive=True).exclude(pk=newest).update(vpactive=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('standin', '0007_plan_statistics'),
+    ]
+
+    operations = [
+        migrations.RunPython(deactivateOldPlans, migrations.RunPython.noop),
+    ]
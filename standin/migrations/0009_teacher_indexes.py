@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 03:00
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('standin', '0008_single_active_plan'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='planentry',
+            index_together=set([('header', 'course', 'day'), ('header', 'day', 'grade', 'hour'), ('header', 'supplyTeacher', 'day')]),
+        ),
+    ]
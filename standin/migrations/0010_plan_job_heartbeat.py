@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 03:16
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('standin', '0009_teacher_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='planjob',
+            name='heartbeat',
+            field=models.DateTimeField(null=True, verbose_name='Heartbeat'),
+        ),
+    ]
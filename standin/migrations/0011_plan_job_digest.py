@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 03:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('standin', '0010_plan_job_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='planjob',
+            name='digest',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=40),
+        ),
+    ]
@@ -17,13 +17,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from bitfield import BitField
-from standin.helpers import PlanIterer, PlanEntryGroup
+from standin.helpers import PlanIterer, groupEntries, ENTRY_TYPES, PlanRow, TeacherRef, SubjectRef, DivisionRef, GradeRef, CourseRef
 from standin import settings as app_settings
-import datetime, uuid
+import datetime, json, uuid
 
 class Teacher(models.Model):
 	"""A teacher in school.
@@ -52,6 +54,10 @@ class Teacher(models.Model):
 	first_name = models.CharField(max_length=120, null=True)
 	last_name = models.CharField(max_length=120, null=True)
 	code = models.CharField(max_length=120, unique=True, null=True)
+	# the names to display are stored, so rendering a plan needs neither
+	# the user nor the settings (see refreshDisplayNames()).
+	pupilName = models.CharField(max_length=255, null=True, editable=False)
+	teacherName = models.CharField(max_length=255, null=True, editable=False)
 
 	def get_full_name(self):
 		"""Get the full name of the teacher"""
@@ -64,20 +70,65 @@ class Teacher(models.Model):
 			return self.user.get_full_name()
 	get_full_name.short_description = _('Full name')
 
+	def getKnownFullName(self):
+		"""Returns the full name or None, if it is not known."""
+		if self.user is None and (self.first_name is None or self.last_name is None):
+			return None
+		return self.get_full_name()
+
 	@property
 	def dspName(self):
 		"""Returns the name to display according to the settings."""
-		# if the full name is not available, return the code.
-		if (self.user is None and (self.first_name is None or self.last_name is None)) or not app_settings.get(app_settings.PLAN_PUPIL_TEACHER_FULLNAME):
-			return self.code
+		if self.pupilName is not None:
+			return self.pupilName
+		return Teacher.formatName(self.code, self.getKnownFullName())
 
-		dspName = self.get_full_name()
+	@staticmethod
+	def formatName(code, fullName, settings=None):
+		"""Returns the name to display according to the settings (fullName is None if unknown)."""
+		if settings is None:
+			settings = app_settings.snapshot()
+		if fullName is None or not settings.PLAN_PUPIL_TEACHER_FULLNAME:
+			return code
+
+		dspName = fullName
 		# append abbreviation?
-		if app_settings.get(app_settings.PLAN_PUPIL_TEACHER_SHORTCUT):
-			dspName += ' (%s)' % (self.code,)
+		if settings.PLAN_PUPIL_TEACHER_SHORTCUT:
+			dspName += ' (%s)' % (code,)
 
 		return dspName
 
+	@staticmethod
+	def displayNames(code, fullName, settings=None):
+		"""Returns the stored display names (as dictionary of field values)."""
+		return {
+			'pupilName': Teacher.formatName(code, fullName, settings),
+			'teacherName': code if not fullName else '%s (%s)' % (fullName, code),
+		}
+
+	@staticmethod
+	def getLinkedNames():
+		"""Returns the full names of all teachers linked to a user (id -> name)."""
+		teachers = Teacher.objects.filter(user__isnull=False).select_related('user')
+		return {t.id: t.get_full_name() for t in teachers}
+
+	@staticmethod
+	def refreshDisplayNames(teachers=None):
+		"""Recalculates the stored display names and saves the changed ones."""
+		if teachers is None:
+			teachers = Teacher.objects.select_related('user')
+		return _refreshDisplayNames(
+			teachers, lambda t: Teacher.displayNames(t.code, t.getKnownFullName())
+		)
+
+	def save(self, *args, **kwargs):
+		changed = _setDisplayNames(self, Teacher.displayNames(self.code, self.getKnownFullName()))
+		if kwargs.get('update_fields') is not None:
+			kwargs['update_fields'] = set(kwargs['update_fields']) | {'pupilName', 'teacherName'}
+		super(Teacher, self).save(*args, **kwargs)
+		if changed:
+			_invalidatePlans()
+
 	def __str__(self):
 		"""Returns representation of a teacher"""
 		return '%s' % (self.code,)
@@ -101,21 +152,80 @@ class Subject(models.Model):
 	# the attributes cannot change!
 	fullname = models.CharField(max_length=80)
 	code = models.CharField(max_length=20, unique=True)
+	# stored names to display (see Teacher).
+	pupilName = models.CharField(max_length=255, null=True, editable=False)
+	teacherName = models.CharField(max_length=255, null=True, editable=False)
 
 	@property
 	def dspName(self):
+		"""Returns the name to display according to the settings."""
+		if self.pupilName is not None:
+			return self.pupilName
+		return Subject.formatName(self.code, self.fullname)
+
+	@staticmethod
+	def formatName(code, fullname, settings=None):
 		"""Returns the name to display according to the settings."""
 		# if the full name is not available, return the code.
-		if self.fullname is None or not app_settings.get(app_settings.PLAN_PUPIL_SUBJECT_FULLNAME):
-			return self.code
+		if settings is None:
+			settings = app_settings.snapshot()
+		if fullname is None or not settings.PLAN_PUPIL_SUBJECT_FULLNAME:
+			return code
 
-		dspName = self.fullname
+		dspName = fullname
 		# append abbreviation?
-		if app_settings.get(app_settings.PLAN_PUPIL_SUBJECT_SHORTCUT):
-			dspName += ' (%s)' % (self.code,)
+		if settings.PLAN_PUPIL_SUBJECT_SHORTCUT:
+			dspName += ' (%s)' % (code,)
 
 		return dspName
 
+	@staticmethod
+	def displayNames(code, fullname, settings=None):
+		"""Returns the stored display names (as dictionary of field values)."""
+		return {
+			'pupilName': Subject.formatName(code, fullname, settings),
+			'teacherName': code if not fullname else '%s (%s)' % (fullname, code),
+		}
+
+	@staticmethod
+	def refreshDisplayNames(subjects=None):
+		"""Recalculates the stored display names and saves the changed ones."""
+		if subjects is None:
+			subjects = Subject.objects.all()
+		return _refreshDisplayNames(subjects, lambda s: Subject.displayNames(s.code, s.fullname))
+
+	def save(self, *args, **kwargs):
+		changed = _setDisplayNames(self, Subject.displayNames(self.code, self.fullname))
+		if kwargs.get('update_fields') is not None:
+			kwargs['update_fields'] = set(kwargs['update_fields']) | {'pupilName', 'teacherName'}
+		super(Subject, self).save(*args, **kwargs)
+		if changed:
+			_invalidatePlans()
+
+def _setDisplayNames(obj, names):
+	"""Sets the stored names of obj. Returns True if they changed."""
+	changed = any(getattr(obj, field) != value for field, value in names.items())
+	for field, value in names.items():
+		setattr(obj, field, value)
+	return changed
+
+def _invalidatePlans():
+	"""Drops the cached plans (once the changed names are committed)."""
+	from standin import cache
+	transaction.on_commit(cache.invalidate)
+
+def _refreshDisplayNames(objects, getNames):
+	"""Stores the names returned by getNames(obj) for all given objects (if changed)."""
+	changed = 0
+	for obj in objects:
+		names = getNames(obj)
+		if any(getattr(obj, field) != value for field, value in names.items()):
+			for field, value in names.items():
+				setattr(obj, field, value)
+			type(obj).objects.filter(pk=obj.pk).update(**names)
+			changed += 1
+	return changed
+
 class SchoolYear(models.Model):
 	"""A year of a school
 
@@ -242,12 +352,18 @@ class Plan(models.Model):
 		verbose_name = _('Standin plan')
 		ordering = ['vpdtup']
 		get_latest_by = 'vpdtup'
+		# to find the active plan.
+		index_together = [('vpactive', 'vpdtup')]
 	
 	vpdtup = models.DateTimeField(auto_now_add=True, verbose_name=_('Upload date and time'))
 	vpstand = models.DateTimeField(verbose_name=_('Date and time of data'))
 	# we should consider only active, finished records (so we can create plans without breaking
 	# the view)
 	vpactive = models.BooleanField(default=False, verbose_name=_('Active'))
+	# hash of the uploaded content (to recognize uploads without changes).
+	fingerprint = models.CharField(max_length=40, null=True, editable=False)
+	# figures of the parse run (time, queries, rows and memory per stage) as JSON.
+	statistics = models.TextField(default='{}', editable=False, verbose_name=_('Parse statistics'))
 	
 	def __str__(self):
 		"""Returns representation of a plan"""
@@ -257,20 +373,72 @@ class Plan(models.Model):
 		)
 
 	def activate(self):
-		"""Activates the plan."""
-		self.vpactive = True
-		self.save()
+		"""Activates the plan and deactivates the previously active one.
+
+		Both happen in one transaction while the rows are locked, so there
+		is always exactly one active plan (and concurrent activations wait
+		for each other).
+		"""
+		with transaction.atomic():
+			locked = Plan.objects.select_for_update().filter(models.Q(vpactive=True) | models.Q(pk=self.pk))
+			previous = [pk for pk in locked.values_list('id', flat=True) if pk != self.pk]
+			if len(previous) > 0:
+				Plan.objects.filter(pk__in=previous).update(vpactive=False)
+			self.vpactive = True
+			self.save()
+
+	def getStatistics(self):
+		"""Returns the figures of the parse run as dictionary (see ParseStatistics.asDict)."""
+		return json.loads(self.statistics)
+
+	def getParseSeconds(self):
+		seconds = self.getStatistics().get('seconds')
+		return '%.2f s' % (seconds,) if seconds is not None else '-'
+	getParseSeconds.short_description = _('Parse time')
+
+	def getParseQueries(self):
+		return self.getStatistics().get('queries', '-')
+	getParseQueries.short_description = _('Queries')
+
+	def getParseRows(self):
+		stages = self.getStatistics().get('stages', {})
+		return '+%d ~%d' % (
+			sum(s['created'] for s in stages.values()), sum(s['updated'] for s in stages.values())
+		)
+	getParseRows.short_description = _('Rows created / updated')
+
+	def getPeakMemory(self):
+		peak = self.getStatistics().get('peakMemory')
+		return '%.1f MiB' % (peak / 1024,) if peak is not None else '-'
+	getPeakMemory.short_description = _('Peak memory')
+
+	@staticmethod
+	def getActivePlan(forUpdate=False):
+		"""Returns the most recent active plan (or None).
+
+		With forUpdate, the row is locked until the end of the transaction.
+		"""
+		plans = Plan.objects.filter(vpactive=True).order_by('-vpdtup')
+		if forUpdate:
+			plans = plans.select_for_update()
+		return plans.first()
 
 	def getAvailableDays(self):
 		"""Returns all days which are sent in this plan."""
 		return self.entries.values('day').distinct()
 
+	@staticmethod
+	def getStartDate():
+		"""Returns the first day shown in the plans (today)."""
+		strDate = datetime.date.today()
+		strDate = datetime.date(2016, 1, 25)
+		return strDate
+
 	def getNextDays(self, days=2, strDate=None):
 		"""Return only those n-days in future."""
 		# If no date is given, start from today.
 		if strDate is None:
-			strDate = datetime.date.today()
-			strDate = datetime.date(2016, 1, 25)
+			strDate = Plan.getStartDate()
 		# At least one day must be given!
 		if days < 1:
 			days = 1
@@ -285,15 +453,8 @@ class Plan(models.Model):
 		else:
 			return self.entries.filter(day__in=days).all()
 
-	def getPupilPlan(self, days=2, grades = None, group=True):
-		"""Returns a prepared plan for pupil view for the next n-days."""
-		result = PlanIterer()
-
-		# first get a list of days.
-		days = self.getNextDays(days)
-		for d in days:
-			result.addDay(d['day'])
-
+	def getPupilEntries(self, days, grades=None):
+		"""Returns the entries relevant for pupils of the given days (and grades)."""
 		# Get all entries for the given criteria.
 		entries = self.entries.filter(day__in=days, vptype__gt=0)
 		# only for specific grades?
@@ -301,27 +462,49 @@ class Plan(models.Model):
 			entries = entries.filter(grade__in=grades)
 		# ignore duties!
 		entries = entries.exclude(vptype__exact=PlanEntry.vptype.DUTY)
-		entries = entries.order_by('day', 'grade__code', 'hour')
+		# everything shown in the plan is fetched at once (instead of one query per row).
+		entries = entries.select_related(
+			'grade__division', 'course__teacher__user', 'course__subject',
+			'supplyTeacher__user', 'supplySubject'
+		)
+		return entries.order_by('day', 'grade__code', 'hour')
+
+	def getPupilRows(self, days, grades=None):
+		"""Same as getPupilEntries, but returns lightweight rows (see PlanRowReader)."""
+		return PlanRowReader().read(self.getPupilEntries(days, grades))
+
+	def getPupilPlan(self, days=2, grades = None, group=True):
+		"""Returns a prepared plan for pupil view for the next n-days."""
+		# first get a list of days.
+		days = self.getNextDays(days)
+		return self._buildPlan(days, self.getPupilRows(days, grades), group)
+
+	def getTeacherEntries(self, teacher, days):
+		"""Returns the entries of the given days concerning a teacher (own courses and supplies)."""
+		entries = self.entries.filter(day__in=days, vptype__gt=0).filter(
+			models.Q(course__in=Course.objects.filter(teacher=teacher)) | models.Q(supplyTeacher=teacher)
+		)
+		return entries.order_by('day', 'grade__code', 'hour')
+
+	def getTeacherRows(self, teacher, days):
+		"""Same as getTeacherEntries, but returns lightweight rows with the names for teachers."""
+		return PlanRowReader(names='teacherName').read(self.getTeacherEntries(teacher, days))
+
+	def getTeacherPlan(self, teacher, days=2, group=True):
+		"""Returns a prepared plan of a single teacher for the next n-days (see getPupilPlan)."""
+		days = self.getNextDays(days)
+		return self._buildPlan(days, self.getTeacherRows(teacher, days), group)
+
+	def _buildPlan(self, days, entries, group):
+		result = PlanIterer()
+		for d in days:
+			result.addDay(d['day'])
+
 		# now we need to group and to put it in right place.
-		previousEntry = None
-		for e in entries.all():
-			# first entry?
-			if previousEntry is None:
-				previousEntry = e
-				continue
-			# Is it similiar?
-			if group and e.similiar(previousEntry):
-				if hasattr(previousEntry, 'is_group'):
-					previousEntry.add(e)
-				else:
-					previousEntry = PlanEntryGroup.createGroup(previousEntry, e)
-			else:
-				result.addEntry(previousEntry)
-				previousEntry = e
-		# Left entry?
-		if previousEntry is not None:
-			result.addEntry(previousEntry)
-			del(previousEntry)
+		if group:
+			entries = groupEntries(entries)
+		for e in entries:
+			result.addEntry(e)
 
 		return result
 
@@ -330,6 +513,12 @@ class PlanEntry(models.Model):
 
 	class Meta:
 		verbose_name = _('Standin')
+		# The pupil plan filters by plan, day and class and orders by hour. The index
+		# serves the distinct days of a plan as well (leftmost columns).
+		# pupil plan (by class) and teacher plan (by course or supply teacher).
+		index_together = [
+			('header', 'day', 'grade', 'hour'), ('header', 'supplyTeacher', 'day'), ('header', 'course', 'day')
+		]
 	
 	# An entry is always a part of a "plan". Add the reference here.
 	header = models.ForeignKey(Plan, verbose_name=_('Plan header'), related_name='entries')
@@ -361,18 +550,20 @@ class PlanEntry(models.Model):
 	note = models.TextField(max_length=550, null=True, verbose_name=_('Information'))
 	# Depending on the data, there are different types
 	# (e.g. moved, free, normal standin, cancelled).
-	vptype = BitField(default=0, flags=(
-		#'UNKNOWN', # 0
-		'CANCELLED', # 1
-		'ROOM', # 2
-		'TEACHER', # 4
-		'SUBJECT', # 8
-		'DATETIME', # 16
-		'MOVED_FROM', # 32
-		'MOVED_TO', # 64
-		'FREE', # 128
-		'DUTY' # 512
-	))
+	vptype = BitField(default=0, flags=ENTRY_TYPES)
+
+	# Fingerprints used by delta uploads: the key identifies the lesson (lesson, day and class)
+	# and the fingerprint its changes.
+	lessonKey = models.CharField(max_length=40, null=True, editable=False)
+	fingerprint = models.CharField(max_length=40, null=True, editable=False)
+
+	def getGroupKey(self):
+		"""Returns all values which must be equal to group entries (everything beside of the hour)."""
+		return (
+			self.header_id, self.day, self.grade_id, self.course_id, self.room,
+			self.supplyTeacher_id, self.supplySubject_id, self.supplyRoom, self.supplyDate,
+			self.supplyHour, self.supplyTimeStart, self.supplyTimeEnd, self.note, int(self.vptype)
+		)
 
 	def similiar(self, entry):
 		"""Compares two objects and checks whether they're similiar (beside of hour)."""
@@ -380,16 +571,7 @@ class PlanEntry(models.Model):
 		if (self.hour - entry.hour) > 1:
 			return False
 
-		for attr in self.__dict__:
-			# skip hidden one and hour, timeStart and timeEnd
-			if attr in ['id', 'hour', 'timeStart', 'timeEnd'] or attr.startswith('_'):
-				continue
-			elif not hasattr(entry, attr):
-				return False
-			elif getattr(self, attr) != getattr(entry, attr):
-				return False
-
-		return True
+		return self.getGroupKey() == entry.getGroupKey()
 
 	@property
 	def isCancelled(self):
@@ -423,3 +605,194 @@ class PlanEntry(models.Model):
 			self.day.strftime('%x'),
 		)
 
+
+class PlanChangelog(models.Model):
+	"""Changes of a plan caused by a single (delta) upload.
+
+	The changes are stored in a compact way: for every inserted, updated
+	and removed entry just the day, the class code and the hour.
+	"""
+
+	class Meta:
+		verbose_name = _('Plan changelog')
+		ordering = ['created']
+		get_latest_by = 'created'
+
+	header = models.ForeignKey(Plan, verbose_name=_('Plan header'), related_name='changelogs')
+	created = models.DateTimeField(auto_now_add=True, verbose_name=_('Upload date and time'))
+	vpstand = models.DateTimeField(verbose_name=_('Date and time of data'))
+	inserted = models.PositiveIntegerField(default=0, verbose_name=_('Inserted entries'))
+	updated = models.PositiveIntegerField(default=0, verbose_name=_('Updated entries'))
+	removed = models.PositiveIntegerField(default=0, verbose_name=_('Removed entries'))
+	changes = models.TextField(default='{}', verbose_name=_('Changes'))
+
+	def getChanges(self):
+		"""Returns the changes as dictionary (inserted, updated, removed -> list of [day, class, hour])."""
+		return json.loads(self.changes)
+
+	def hasChanges(self):
+		return (self.inserted + self.updated + self.removed) > 0
+
+	def __str__(self):
+		"""Returns representation of a changelog"""
+		return '+%d ~%d -%d' % (self.inserted, self.updated, self.removed)
+
+class PlanJob(models.Model):
+	"""An uploaded plan waiting to be (or being) parsed.
+
+	Uploads are stored and parsed in the background one after another (see
+	standin.ingest). If several uploads are waiting, only the newest one is
+	parsed, the others are skipped.
+	"""
+
+	QUEUED = 'queued'
+	RUNNING = 'running'
+	DONE = 'done'
+	FAILED = 'failed'
+	SKIPPED = 'skipped'
+	STATUS_CHOICES = (
+		(QUEUED, _('Queued')),
+		(RUNNING, _('Running')),
+		(DONE, _('Done')),
+		(FAILED, _('Failed')),
+		(SKIPPED, _('Skipped')),
+	)
+
+	class Meta:
+		verbose_name = _('Plan upload')
+		ordering = ['-created']
+		get_latest_by = 'created'
+
+	planFile = models.FileField(upload_to='standin/uploads/', null=True, verbose_name=_('Plan file'))
+	name = models.CharField(max_length=255, verbose_name=_('File name'))
+	# SHA-1 of the file (set by the drop directory importer to skip duplicates).
+	digest = models.CharField(max_length=40, blank=True, default='', db_index=True, editable=False)
+	status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED, verbose_name=_('Status'))
+	created = models.DateTimeField(auto_now_add=True, verbose_name=_('Upload date and time'))
+	started = models.DateTimeField(null=True, verbose_name=_('Started'))
+	finished = models.DateTimeField(null=True, verbose_name=_('Finished'))
+	# last sign of life of the worker parsing the plan (see standin.ingest.Heartbeat).
+	heartbeat = models.DateTimeField(null=True, verbose_name=_('Heartbeat'))
+	stage = models.CharField(max_length=40, blank=True, default='', verbose_name=_('Stage'))
+	progress = models.PositiveSmallIntegerField(default=0, verbose_name=_('Progress'))
+	error = models.TextField(blank=True, default='', verbose_name=_('Error'))
+	plan = models.ForeignKey(Plan, null=True, on_delete=models.SET_NULL, verbose_name=_('Plan header'))
+
+	def getDuration(self):
+		"""Returns the time needed to parse the plan (or None if not finished)."""
+		if self.started is None or self.finished is None:
+			return None
+		return self.finished - self.started
+	getDuration.short_description = _('Duration')
+
+	def isPending(self):
+		return self.status in (PlanJob.QUEUED, PlanJob.RUNNING)
+
+	def __str__(self):
+		"""Returns representation of an upload"""
+		return '%s (%s)' % (self.name, self.get_status_display())
+
+class PlanRowReader:
+	"""Reads plan entries as lightweight rows (PlanRow) instead of model instances.
+
+	The entries are fetched with values_list() joined to the stored display names
+	of teachers and subjects and the names of classes. Every teacher, subject, class and course is
+	represented by one shared reference object.
+	"""
+
+	FIELDS = (
+		'id', 'header_id', 'day', 'hour', 'timeStart', 'timeEnd',
+		'grade_id', 'grade__code', 'grade__division_id', 'grade__division__name',
+		'course_id', 'course__teacher_id', 'course__teacher__code', 'course__teacher__pupilName',
+		'course__subject_id', 'course__subject__code', 'course__subject__pupilName',
+		'room',
+		'supplyTeacher_id', 'supplyTeacher__code', 'supplyTeacher__pupilName',
+		'supplySubject_id', 'supplySubject__code', 'supplySubject__pupilName',
+		'supplyRoom', 'supplyDate', 'supplyHour', 'supplyTimeStart', 'supplyTimeEnd', 'note', 'vptype'
+	)
+
+	def __init__(self, names='pupilName'):
+		# names is the stored name of teachers and subjects to display.
+		self.fields = tuple(f.replace('pupilName', names) for f in self.FIELDS)
+		self.teachers = {}
+		self.subjects = {}
+		self.divisions = {}
+		self.grades = {}
+		self.courses = {}
+
+	def read(self, entries):
+		"""Returns the given entries (queryset) as list of PlanRows."""
+		return [self.createRow(v) for v in entries.values_list(*self.fields)]
+
+	def getTeacher(self, pk, code, dspName):
+		if pk is None:
+			return None
+		teacher = self.teachers.get(pk)
+		if teacher is None:
+			# names are stored by the master data sync (code until then).
+			teacher = TeacherRef(pk, code, dspName if dspName is not None else code)
+			self.teachers[pk] = teacher
+		return teacher
+
+	def getSubject(self, pk, code, dspName):
+		if pk is None:
+			return None
+		subject = self.subjects.get(pk)
+		if subject is None:
+			subject = SubjectRef(pk, code, dspName if dspName is not None else code)
+			self.subjects[pk] = subject
+		return subject
+
+	def getGrade(self, pk, code, divisionId, divisionName):
+		grade = self.grades.get(pk)
+		if grade is None:
+			division = None
+			if divisionId is not None:
+				division = self.divisions.get(divisionId)
+				if division is None:
+					division = DivisionRef(divisionId, divisionName)
+					self.divisions[divisionId] = division
+			grade = GradeRef(pk, code, division)
+			self.grades[pk] = grade
+		return grade
+
+	def getCourse(self, pk, teacher, subject):
+		course = self.courses.get(pk)
+		if course is None:
+			course = CourseRef(pk, teacher, subject)
+			self.courses[pk] = course
+		return course
+
+	def createRow(self, v):
+		teacher = self.getTeacher(v[11], v[12], v[13])
+		subject = self.getSubject(v[14], v[15], v[16])
+		return PlanRow(
+			id=v[0], header_id=v[1], day=v[2], hour=v[3], timeStart=v[4], timeEnd=v[5],
+			grade_id=v[6], grade=self.getGrade(v[6], v[7], v[8], v[9]),
+			course_id=v[10], course=self.getCourse(v[10], teacher, subject),
+			room=v[17],
+			supplyTeacher_id=v[18], supplyTeacher=self.getTeacher(v[18], v[19], v[20]),
+			supplySubject_id=v[21], supplySubject=self.getSubject(v[21], v[22], v[23]),
+			supplyRoom=v[24], supplyDate=v[25], supplyHour=v[26], supplyTimeStart=v[27],
+			supplyTimeEnd=v[28], note=v[29], vptype=int(v[30])
+		)
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def refreshLinkedTeacher(sender, instance, created=False, update_fields=None, **kwargs):
+	"""Updates the stored names of a teacher if the linked user is changed."""
+	# new users are not linked yet; updates of other fields (e.g. last_login) don't matter.
+	if created or (update_fields is not None and not ({'first_name', 'last_name'} & set(update_fields))):
+		return
+	if Teacher.refreshDisplayNames(Teacher.objects.filter(user=instance).select_related('user')) > 0:
+		_invalidatePlans()
+
+def refreshAllDisplayNames(**kwargs):
+	"""Updates the stored names after the preferences are changed."""
+	Teacher.refreshDisplayNames()
+	Subject.refreshDisplayNames()
+
+try:
+	from siteprefs.signals import prefs_save
+	prefs_save.connect(refreshAllDisplayNames)
+except ImportError:
+	pass
@@ -18,100 +18,749 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
 from standin import settings as app_settings
-from standin.models import Teacher, Subject, SchoolYear, Division, Course, Plan, PlanEntry, Grade
+from standin import cache, registry
+from standin.signals import plan_parsed
+from standin.models import Teacher, Subject, Division, Course, Plan, PlanEntry, PlanChangelog, Grade
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-import django.dispatch
-import json, pytz, re
+from functools import lru_cache
+import codecs, hashlib, json, logging, pytz, re, time, tracemalloc, uuid
+
+# ijson is optional and only needed to stream large files.
+try:
+	import ijson
+	from ijson.common import ObjectBuilder
+except ImportError:
+	ijson = None
+
+logger = logging.getLogger(__name__)
 
-# Define signals
-plan_parsed = django.dispatch.Signal(providing_args=[])
 
 class PlanParseException(Exception):
 	"""Populated if a standin plan could not be parsed."""
 	pass
 
+class CountingCursor:
+	"""Wraps a cursor and counts the executed statements (see QueryCounter)."""
+
+	def __init__(self, cursor, counter):
+		self.cursor = cursor
+		self.counter = counter
+
+	def execute(self, *args, **kwargs):
+		self.counter.count += 1
+		return self.cursor.execute(*args, **kwargs)
+
+	def executemany(self, *args, **kwargs):
+		self.counter.count += 1
+		return self.cursor.executemany(*args, **kwargs)
+
+	def __getattr__(self, name):
+		return getattr(self.cursor, name)
+
+	def __iter__(self):
+		return iter(self.cursor)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		return self.cursor.__exit__(*args)
+
+class QueryCounter:
+	"""Counts the queries of a connection while it is active.
+
+	Only the cursors of the given connection object are wrapped (every
+	thread has its own), the query log of django is neither needed nor
+	touched.
+	"""
+
+	def __init__(self, connection):
+		self.connection = connection
+		self.count = 0
+
+	def __enter__(self):
+		self._patched = {}
+		for name in ('make_cursor', 'make_debug_cursor'):
+			self._patched[name] = self.connection.__dict__.get(name)
+			make = getattr(self.connection, name)
+			setattr(self.connection, name, lambda cursor, make=make: CountingCursor(make(cursor), self))
+		return self
+
+	def __exit__(self, *args):
+		for name, previous in self._patched.items():
+			if previous is None:
+				delattr(self.connection, name)
+			else:
+				setattr(self.connection, name, previous)
+
+class MemoryPeak:
+	"""Measures the peak of the memory allocated while it is active (in KiB).
+
+	tracemalloc is started by the outermost measurement (and stopped
+	afterwards). Nested measurements need tracemalloc.reset_peak() (Python
+	3.9), otherwise their peak is unknown (None).
+	"""
+
+	def __init__(self, parent=None):
+		self.parent = parent
+		self.peak = None
+		# highest peak seen before nested measurements reset it.
+		self._seen = 0
+
+	def __enter__(self):
+		self._owner = not tracemalloc.is_tracing()
+		self._base = None
+		if self._owner:
+			tracemalloc.start()
+			self._base = 0
+		elif hasattr(tracemalloc, 'reset_peak'):
+			current, peak = tracemalloc.get_traced_memory()
+			if self.parent is not None:
+				self.parent._seen = max(self.parent._seen, peak)
+			tracemalloc.reset_peak()
+			self._base = current
+		return self
+
+	def __exit__(self, *args):
+		if self._base is not None:
+			peak = max(self._seen, tracemalloc.get_traced_memory()[1])
+			self.peak = max(0, peak - self._base) // 1024
+			if self.parent is not None:
+				self.parent._seen = max(self.parent._seen, peak)
+		if self._owner:
+			tracemalloc.stop()
+
+class StageStatistics:
+	"""Figures of a single stage of a parse run."""
+
+	def __init__(self, name):
+		self.name = name
+		self.rows = 0
+		self.created = 0
+		self.updated = 0
+		self.deleted = 0
+		self.queries = 0
+		self.seconds = 0.0
+		self.peakMemory = None
+
+	def asDict(self):
+		return {
+			'rows': self.rows,
+			'created': self.created,
+			'updated': self.updated,
+			'deleted': self.deleted,
+			'queries': self.queries,
+			'seconds': round(self.seconds, 4),
+			'peakMemory': self.peakMemory,
+		}
+
+	def __str__(self):
+		return '%s: %d rows (%d created, %d updated, %d deleted), %d queries, %.3f s' % (
+			self.name, self.rows, self.created, self.updated, self.deleted, self.queries, self.seconds
+		)
+
+class LookupStatistics:
+	"""Hits and misses of a lookup cache."""
+
+	def __init__(self, name):
+		self.name = name
+		self.hits = 0
+		self.misses = 0
+
+	def asDict(self):
+		return {'hits': self.hits, 'misses': self.misses}
+
+	def __str__(self):
+		return '%s: %d hits, %d misses' % (self.name, self.hits, self.misses)
+
+class ParseStatistics:
+	"""Collects the figures of all stages of a parse run."""
+
+	def __init__(self, listener=None, traceMemory=False):
+		self.stages = OrderedDict()
+		self.lookups = OrderedDict()
+		# called with the StageStatistics whenever a stage is entered.
+		self.listener = listener
+		# time and queries of nested stages (they are not counted twice).
+		self._nested = []
+		self._queries = None
+		self._start = time.perf_counter()
+		self.seconds = None
+		# highest peak of all stages (in KiB, None if the memory is not traced).
+		self.traceMemory = traceMemory
+		self.peakMemory = None
+
+	def stage(self, name):
+		"""Returns the statistics of the given stage (created on first access)."""
+		if name not in self.stages:
+			self.stages[name] = StageStatistics(name)
+		return self.stages[name]
+
+	def lookup(self, name):
+		"""Returns the statistics of the given lookup cache (created on first access)."""
+		if name not in self.lookups:
+			self.lookups[name] = LookupStatistics(name)
+		return self.lookups[name]
+
+	@contextmanager
+	def measure(self, name):
+		"""Counts the time and the queries while the block is running.
+
+		If stages are nested, the inner stage is not counted for the outer one.
+		"""
+		stage = self.stage(name)
+		if self.listener is not None:
+			self.listener(stage)
+		# the outermost stage counts the queries for all nested ones.
+		outermost = len(self._nested) == 0
+		if outermost:
+			self._queries = QueryCounter(connections[DEFAULT_DB_ALIAS]).__enter__()
+		# tracemalloc slows down (and counts) all threads of the process, so only on request.
+		memory = None
+		if self.traceMemory:
+			memory = MemoryPeak(None if outermost else self._nested[-1][2]).__enter__()
+		nested = [0.0, 0, memory]
+		self._nested.append(nested)
+		start = time.perf_counter()
+		queries = self._queries.count
+		try:
+			yield stage
+		finally:
+			seconds = time.perf_counter() - start
+			count = self._queries.count - queries
+			if memory is not None:
+				memory.__exit__()
+			self._nested.pop()
+			if outermost:
+				self._queries.__exit__()
+			stage.seconds += seconds - nested[0]
+			stage.queries += count - nested[1]
+			if memory is not None and memory.peak is not None:
+				stage.peakMemory = max(stage.peakMemory or 0, memory.peak)
+				self.peakMemory = max(self.peakMemory or 0, memory.peak)
+			if len(self._nested) > 0:
+				self._nested[-1][0] += seconds
+				self._nested[-1][1] += count
+
+	def finish(self):
+		"""Stops the clock of the whole run."""
+		self.seconds = time.perf_counter() - self._start
+
+	def asDict(self):
+		return {
+			'seconds': round(self.seconds, 4) if self.seconds is not None else None,
+			'queries': sum(stage.queries for stage in self.stages.values()),
+			'peakMemory': self.peakMemory,
+			'stages': OrderedDict((name, stage.asDict()) for name, stage in self.stages.items()),
+			'lookups': OrderedDict((name, lookup.asDict()) for name, lookup in self.lookups.items()),
+		}
+
+	def __iter__(self):
+		for s in self.stages.values():
+			yield s
+
+class MasterDataSync:
+	"""Synchronises master data (teachers, subjects, ...) in bulk.
+
+	Instead of asking the database for every single record, all existing
+	rows are fetched with one query per model, compared with the export
+	and only the differences are written.
+	"""
+
+	def __init__(self, statistics, batchSize=None):
+		self.statistics = statistics
+		self.batchSize = batchSize
+
+	def sync(self, stage, model, records):
+		"""Syncs the records (pk -> dict of field values) of the given model.
+
+		Returns a dictionary pk -> model instance of all synced records.
+		"""
+		with self.statistics.measure(stage) as stats:
+			stats.rows += len(records)
+			existing = model.objects.in_bulk(list(records.keys()))
+			created = []
+			updated = []
+			for pk, values in records.items():
+				obj = existing.get(pk)
+				if obj is None:
+					obj = model(pk=pk, **values)
+					created.append(obj)
+					existing[pk] = obj
+					continue
+
+				changed = False
+				for field, value in values.items():
+					if getattr(obj, field) != value:
+						setattr(obj, field, value)
+						changed = True
+				if changed:
+					updated.append(obj)
+
+			if len(created) > 0:
+				model.objects.bulk_create(created, batch_size=self.batchSize)
+			if len(updated) > 0:
+				fields = list(records[updated[0].pk].keys())
+				# bulk_update is only available in newer django versions.
+				if hasattr(model.objects, 'bulk_update'):
+					model.objects.bulk_update(updated, fields, batch_size=self.batchSize)
+				else:
+					for obj in updated:
+						obj.save(update_fields=fields)
+			stats.created += len(created)
+			stats.updated += len(updated)
+
+		return existing
+
+class LookupCache:
+	"""Resolves references of an export to the synced rows without asking the database."""
+
+	def __init__(self, name, rows, statistics, normalize=None):
+		self.name = name
+		self._rows = rows
+		self._normalize = normalize
+		self._stats = statistics.lookup(name)
+
+	def get(self, key):
+		"""Returns the row for the given key or raises a PlanParseException."""
+		try:
+			if self._normalize is not None:
+				key = self._normalize(key)
+			obj = self._rows[key]
+		except (KeyError, ValueError):
+			self._stats.misses += 1
+			raise PlanParseException('Unknown %s %s' % (self.name, key))
+
+		self._stats.hits += 1
+		return obj
+
+@lru_cache(maxsize=1024)
+def parseDate(value):
+	"""Parses a date of DaVinci (e.g. 20160125). The same dates occur again and again,
+	so the results are memoized."""
+	return datetime.strptime(value, '%Y%m%d').date()
+
+@lru_cache(maxsize=1024)
+def parseTime(value):
+	"""Parses a time of DaVinci (e.g. 0745), memoized as well."""
+	return datetime.strptime(value, '%H%M').time()
+
+class CaptionResolver:
+	"""Resolves the captions of moved lessons ("moved to" / "moved from").
+
+	The regular expressions are compiled only once per parse and the hours
+	of the timetable are indexed in both directions (start time <-> hour).
+	"""
+
+	def __init__(self, settings=None):
+		if settings is None:
+			settings = app_settings.snapshot()
+		self.movedTo = self._compile(settings.PLAN_PARSER_REGEX_MOVED_TO)
+		self.movedFrom = self._compile(settings.PLAN_PARSER_REGEX_MOVED_FROM)
+		self._hours = {}
+		self._startTimes = {}
+
+	def _compile(self, regex):
+		if regex is None or len(regex) <= 0:
+			return None
+		return re.compile(regex)
+
+	def addTimeslot(self, startTime, hour):
+		"""Adds an hour of the timetable (start time as given by DaVinci, e.g. 0745)."""
+		self._hours[startTime] = hour
+		self._startTimes[hour] = parseTime(startTime)
+
+	def getHour(self, startTime):
+		"""Returns the hour starting at the given time (or None)."""
+		return self._hours.get(startTime)
+
+	def getStartTime(self, hour):
+		"""Returns the start time of the given hour (or None)."""
+		return self._startTimes.get(hour)
+
+	def resolveMovedTo(self, caption, day, startTime):
+		"""Returns the date and hour the lesson is moved to (or None)."""
+		return self._resolve(self.movedTo, caption, day, startTime)
+
+	def resolveMovedFrom(self, caption, day, startTime):
+		"""Returns the date and hour the lesson is moved from (or None)."""
+		return self._resolve(self.movedFrom, caption, day, startTime)
+
+	def _resolve(self, regex, caption, day, startTime):
+		if regex is None:
+			return None
+		r = regex.match(caption)
+		if r is None:
+			return None
+
+		now = datetime(day.year, day.month, day.day, startTime.hour, startTime.minute)
+		hour = int(r.group('startHour'))
+		startHour = self.getStartTime(hour)
+		if startHour is None:
+			startHour = datetime.now().time()
+		# the caption does not contain the year.
+		future = datetime(now.year, int(r.group('month')), int(r.group('day')), startHour.hour, startHour.minute)
+		# if the future is already the past, we have to exchange:
+		if future < now:
+			past = future
+			future = past.replace(year=past.year + 1)
+		else:
+			past = future.replace(year=future.year - 1)
+		# depending on whats close to original date, we use that.
+		if (future - now) <= (now - past):
+			return future.date(), hour
+		else:
+			return past.date(), hour
+
+class PlanDelta:
+	"""Compares the entries of an upload with the entries of the active plan.
+
+	Entries are identified by their lesson key. Only entries which are new,
+	whose fingerprint changed or which are not part of the upload anymore
+	need to be written. A lesson can occur more than once a day with the same
+	key (e.g. at different times), so every key holds a list of the entries
+	which are not paired with an entry of the upload yet.
+	"""
+
+	def __init__(self, plan):
+		self.plan = plan
+		self.inserted = []
+		self.updated = []
+		self.removed = []
+		self._existing = {}
+		for key, pk, fingerprint, day, grade, hour in plan.entries.order_by('id').values_list(
+			'lessonKey', 'id', 'fingerprint', 'day', 'grade__code', 'hour'
+		):
+			# entries written before delta uploads existed are replaced.
+			if key is None:
+				key = 'id:%d' % (pk,)
+			self._existing.setdefault(key, []).append((pk, fingerprint, [day.isoformat(), grade, hour]))
+
+	def pair(self, entry):
+		"""Returns (and removes) the old entry for the given one (preferably an unchanged one)."""
+		olds = self._existing.get(entry.lessonKey)
+		if not olds:
+			return None
+		for pos, old in enumerate(olds):
+			if old[1] == entry.fingerprint:
+				return olds.pop(pos)
+		return olds.pop(0)
+
+	def classify(self, entries):
+		"""Splits the entries in new and changed ones (unchanged entries are dropped)."""
+		new = []
+		changed = []
+		for e in entries:
+			old = self.pair(e)
+			if old is None:
+				new.append(e)
+				self.inserted.append(self.describe(e))
+			elif old[1] != e.fingerprint:
+				e.pk = old[0]
+				changed.append(e)
+				self.updated.append(self.describe(e))
+
+		return new, changed
+
+	def getRemoved(self):
+		"""Returns the ids of all entries which are not part of the upload anymore."""
+		ids = []
+		for olds in self._existing.values():
+			for old in olds:
+				ids.append(old[0])
+				self.removed.append(old[2])
+		return ids
+
+	def describe(self, entry):
+		return [entry.day.isoformat(), entry.grade.code, entry.hour]
+
+	def getChangelog(self):
+		"""Returns the (unsaved) changelog of the upload."""
+		return PlanChangelog(
+			header=self.plan,
+			vpstand=self.plan.vpstand,
+			inserted=len(self.inserted),
+			updated=len(self.updated),
+			removed=len(self.removed),
+			changes=json.dumps(
+				{'inserted': self.inserted, 'updated': self.updated, 'removed': self.removed},
+				separators=(',', ':')
+			)
+		)
+
 class BaseParser:
-	"""Base class to parse a standin plan of a third party app."""
+	"""Base class to parse a standin plan of a third party app.
 
-	def __init__(self):
-		pass
+	Parsers which set supportsStreaming accept a streaming argument and
+	are able to read large files without loading them completely.
+	"""
+
+	supportsStreaming = False
+	# names of the stages in the order they are passed (to report the progress).
+	STAGES = ()
+
+	def __init__(self, progress=None):
+		# the settings are read only once per parse.
+		self.settings = app_settings.Snapshot()
+		self.statistics = ParseStatistics(progress, bool(self.settings.PLAN_PARSE_TRACE_MEMORY))
+		self.plan = None
+		self.changelog = None
+		# set if the upload had the same content as the active plan.
+		self.unchanged = False
 
 	def parse(self):
 		pass
 
+	def prewarm(self):
+		"""Fills the caches with the new plan (once it is committed and visible to all)."""
+		with self.statistics.measure('prewarm'):
+			try:
+				cache.prewarm(self.plan)
+			except Exception:
+				# a failing cache is no reason to reject the plan.
+				logger.exception('Prewarming the cache failed.')
+
 	def finished(self):
-		plan_parsed.send(sender=self.__class__)
+		self.statistics.finish()
+		for stage in self.statistics:
+			logger.info('Parsed %s', stage)
+		for lookup in self.statistics.lookups.values():
+			logger.info('Lookup %s', lookup)
+		logger.info('Parsed plan in %.3f s (peak memory: %s KiB)', self.statistics.seconds, self.statistics.peakMemory)
+		# the figures of uploads without changes would replace those of the active plan.
+		if self.plan is not None and not self.unchanged:
+			self.plan.statistics = json.dumps(self.statistics.asDict())
+			Plan.objects.filter(pk=self.plan.pk).update(statistics=self.plan.statistics)
+		plan_parsed.send(
+			sender=self.__class__, plan=self.plan, changelog=self.changelog, statistics=self.statistics
+		)
 
 class DavinciJsonParser(BaseParser):
 	"""Parser to parse a DaVinci export in JSON format."""
 
-	def __init__(self, fileobj):
-		super().__init__()
+	supportsStreaming = True
+	STAGES = (
+		'decode', 'fingerprint', 'teachers', 'subjects', 'divisions', 'courses', 'classes',
+		'timeframes', 'changes', 'write', 'activate', 'prewarm'
+	)
+	LESSON_PREFIX = 'result.displaySchedule.lessonTimes.item'
+
+	def __init__(self, fileobj, streaming=False, delta=None, progress=None):
+		super().__init__(progress)
 
 		self._jsonfile = fileobj
+		self.streaming = streaming
+		if delta is None:
+			delta = self.settings.PLAN_DELTA_UPLOADS
+		self.deltaMode = bool(delta)
+		self.delta = None
+		self.batchSize = int(self.settings.PLAN_BULK_BATCH_SIZE)
+		self._sync = MasterDataSync(self.statistics, self.batchSize)
 
 		# Get the current school year. If nothing is defined,
 		# we do not need to process the file!
 		self.schoolYear = None
 		try:
-			self.schoolYear = SchoolYear.getCurrentYear()
+			self.schoolYear = registry.getCurrentSchoolYear()
 		except:
 			raise PlanParseException('No matching school year defined!') 
 
 	def parse(self):
 		"""Parses the davinci json file!"""
 		# load the file
-		planContent = self._jsonfile.read()
+		with self.statistics.measure('decode'):
+			if self.streaming:
+				planContent, lessons = self.streamPlan()
+			else:
+				planContent, lessons = self.readPlan()
 
-		if planContent is None:
-			raise PlanParseException('File not readable.')
+		version = self.parseVersion(planContent)
+		with self.statistics.measure('fingerprint'):
+			# streamed lessons are read once more (the generator is needed for the parsing).
+			fingerprint = self.getFingerprint(
+				planContent, lessons if isinstance(lessons, list) else self.streamLessons()
+			)
 
-		# get the encoding from settings (default: utf-8) and decode it.
-		try:
-			planContent = json.loads(planContent.decode(app_settings.get(app_settings.PLAN_FILES_ENCODING)))
-		except ValueError:
-			# in case of UTF-8, we try also the sig variant.
-			if app_settings.get(app_settings.PLAN_FILES_ENCODING) == 'utf-8':
-				planContent = json.loads(planContent.decode('utf-8-sig'))
+		# The whole upload is written in one transaction. Either the plan is
+		# written completely and activated, or nothing is written at all.
+		with transaction.atomic():
+			# the cached pointer of the registry can be stale (it is meant for the views), so the
+			# active plan is read from the database and locked until the upload is written.
+			active = Plan.getActivePlan(forUpdate=True)
+			# nothing changed but the time stamp? Then we keep the active plan.
+			if active is not None and active.fingerprint == fingerprint:
+				self.unchanged = True
+				self.plan = active
+				self.plan.vpstand = version
+				self.plan.save(update_fields=['vpstand'])
+				logger.info('Upload has the same content as the active plan, only the time stamp is updated.')
+				# the time stamp is part of the cache keys.
+				transaction.on_commit(self.prewarm)
 			else:
-				raise
+				self.writePlan(planContent, lessons, version, fingerprint, active)
+
+		self.finished()
 
+	def writePlan(self, planContent, lessons, version, fingerprint, active):
+		"""Writes the plan (or the differences to the active plan) and activates it."""
 		# parse file.
 		self.parseTeachers(planContent['result'])
 		self.parseSubjects(planContent['result'])
 		self.parseDivisions(planContent['result'])
 		self.parseCourses(planContent['result'])
 		self.parseClasses(planContent['result'])
-		self.parseTimeFrames(planContent['result'])
+		with self.statistics.measure('timeframes'):
+			self.parseTimeFrames(planContent['result'])
+		self.buildLookups()
+
+		# In delta mode, we update the active plan (if there is one).
+		if self.deltaMode and active is not None:
+			self.plan = active
+			self.plan.vpstand = version
+		else:
+			self.plan = Plan(vpstand=version)
+		self.plan.fingerprint = fingerprint
 
-		# Get the version of the file, in order to create the plan header.
+		# Get each change. The entries are written in batches, so we
+		# never keep more than one batch in memory.
+		self.plan.save()
+		if self.deltaMode:
+			self.delta = PlanDelta(self.plan)
+		changes = []
+		with self.statistics.measure('changes') as stats:
+			for les in lessons:
+				# ignore entries without changes.
+				# maybe they're later more interesting to auto-learn all courses,
+				# not only those with changes.
+				if 'changes' not in les.keys():
+					continue
+
+				stats.rows += 1
+				changes.extend(self.parseChange(les))
+				if len(changes) >= self.batchSize:
+					self.writeEntries(changes)
+					changes = []
+
+		# no error occured? Nice. Save the learned teachers, the entries and activate the plan!
+		self.writeEntries(changes)
+		with self.statistics.measure('write') as stats:
+			for course in self._learnedCourses:
+				course.save(update_fields=['teacher'])
+			if self.delta is not None:
+				removed = self.delta.getRemoved()
+				for i in range(0, len(removed), self.batchSize):
+					PlanEntry.objects.filter(id__in=removed[i:i + self.batchSize]).delete()
+				stats.deleted += len(removed)
+				self.changelog = self.delta.getChangelog()
+				self.changelog.save()
+		# the first request after the upload should not need to build the plan.
+		transaction.on_commit(self.prewarm)
+		with self.statistics.measure('activate'):
+			self.plan.activate()
+
+	def parseVersion(self, planContent):
+		"""Returns the version of the file (date and time of the export)."""
 		version = planContent['about']['serverTimeStamp']
 		version = datetime.strptime(version, '%Y%m%d %H%M')
 		if settings.USE_TZ:
 			version = version.replace(tzinfo=pytz.timezone(settings.TIME_ZONE))
-		self.plan = Plan(vpstand=version)
+		return version
+
+	def getFingerprint(self, planContent, lessons):
+		"""Returns a hash of everything of the export which ends up in the plan.
+
+		The time stamp of the export is left out and the order of the
+		lessons does not matter.
+		"""
+		result = planContent['result']
+		fingerprint = hashlib.sha1()
+		for key in ('teachers', 'subjects', 'teams', 'courses', 'classes', 'timeframes'):
+			fingerprint.update(self._canonical(result.get(key)))
+		# only lessons with changes are parsed.
+		changes = sorted(hashlib.sha1(self._canonical(les)).digest() for les in lessons if 'changes' in les)
+		for digest in changes:
+			fingerprint.update(digest)
+		return fingerprint.hexdigest()
+
+	def _canonical(self, value):
+		# ijson returns numbers as Decimal, json as int or float.
+		number = lambda d: int(d) if d == d.to_integral_value() else float(d)
+		return json.dumps(value, sort_keys=True, separators=(',', ':'), default=number).encode('utf-8')
+
+	def readPlan(self):
+		"""Reads and decodes the whole file at once.
+
+		Returns the decoded content and the list of lessons.
+		"""
+		planContent = self._jsonfile.read()
 
-		# Get each change.
-		self.plan.save()
-		changes = []
-		for les in planContent['result']['displaySchedule']['lessonTimes']:
-			# ignore entries without changes.
-			# maybe they're later more interesting to auto-learn all courses,
-			# not only those with changes.
-			if 'changes' not in les.keys():
-				continue
+		if planContent is None:
+			raise PlanParseException('File not readable.')
 
-			result = self.parseChange(les)
-			changes.extend(result)
-			del(result)
+		# get the encoding from settings (default: utf-8) and decode it.
+		try:
+			planContent = json.loads(planContent.decode(self.settings.PLAN_FILES_ENCODING))
+		except ValueError:
+			# in case of UTF-8, we try also the sig variant.
+			if self.settings.PLAN_FILES_ENCODING == 'utf-8':
+				planContent = json.loads(planContent.decode('utf-8-sig'))
+			else:
+				raise
 
-		# no error occured? Nice. Activate the plan!
-		for r in changes:
-			r.save()
-		self.plan.activate()
+		return planContent, planContent['result']['displaySchedule']['lessonTimes']
 
-		self.finished()
+	def streamPlan(self):
+		"""Reads the file incrementally.
+
+		The first pass collects everything beside of the lessons, the returned
+		generator reads the lessons one by one in a second pass. So the memory
+		needed does not depend on the number of lessons in the export.
+		"""
+		if ijson is None:
+			raise PlanParseException('Streaming requires the ijson package.')
+		if self.settings.PLAN_FILES_ENCODING.lower() not in ('utf-8', 'utf8'):
+			# ijson reads utf-8 only; we read the file at once instead.
+			return self.readPlan()
+
+		builder = ObjectBuilder()
+		for prefix, event, value in ijson.parse(self._openStream()):
+			if prefix == self.LESSON_PREFIX or prefix.startswith(self.LESSON_PREFIX + '.'):
+				continue
+			builder.event(event, value)
+
+		return builder.value, self.streamLessons()
+
+	def streamLessons(self):
+		"""Generator for all lessons of the file."""
+		for les in ijson.items(self._openStream(), self.LESSON_PREFIX):
+			yield les
+
+	def _openStream(self):
+		"""Rewinds the file and skips a byte order mark."""
+		self._jsonfile.seek(0)
+		if self._jsonfile.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+			self._jsonfile.seek(0)
+		return self._jsonfile
+
+	def writeEntries(self, entries):
+		"""Writes the given plan entries in one go."""
+		if len(entries) <= 0:
+			return
+
+		with self.statistics.measure('write') as stats:
+			stats.rows += len(entries)
+			if self.delta is not None:
+				entries, changed = self.delta.classify(entries)
+				for e in changed:
+					e.save(force_update=True)
+				stats.updated += len(changed)
+
+			PlanEntry.objects.bulk_create(entries, batch_size=self.batchSize)
+			stats.created += len(entries)
 
 	def parseChange(self, les):
 		"""Parses one change entry (can produce multiple records)."""
@@ -119,31 +768,29 @@ class DavinciJsonParser(BaseParser):
 		entryDates = []
 		vptype = 0
 		for dt in les['dates']:
-			entryDates.append(datetime.strptime(dt, '%Y%m%d').date())
+			entryDates.append(parseDate(dt))
 
 		# start and end time
-		startTime = datetime.strptime(les['startTime'], '%H%M').time()
-		endTime = datetime.strptime(les['endTime'], '%H%M').time()
+		startTime = parseTime(les['startTime'])
+		endTime = parseTime(les['endTime'])
 
 		# to get the hours, we look into our timetable.
-		if les['startTime'] in self.timeframes.keys():
-			hour = self.timeframes[les['startTime']]
-		else:
-			hour = None
+		hour = self.captions.getHour(les['startTime'])
 
 		# Get the teacher
 		teacher = None
 		for t in les['teacherCodes']:
-			teacher = Teacher.objects.get(code=t)
+			teacher = self.teacherLookup.get(t)
 			break
 		if teacher is None:
 			raise PlanParseException('No teacher given with reference %s' % (les['lessonRef'],))
 
-		# Now as we have the teacher, we can update the course if necessary.
-		course = Course.objects.get(id=les['courseRef'])
-		if course.teacher is None:
+		# Now as we have the teacher, we can update the course if necessary
+		# (it is saved together with the entries).
+		course = self.courseLookup.get(les['courseRef'])
+		if course.teacher_id is None:
 			course.teacher = teacher
-			course.save()
+			self._learnedCourses.append(course)
 
 		# Get the affected classes
 		classes = []
@@ -167,14 +814,14 @@ class DavinciJsonParser(BaseParser):
 		# The supply subject is?
 		chgSubject = None
 		if 'newSubjectCode' in les['changes'].keys():
-			chgSubject = Subject.objects.get(code=les['changes']['newSubjectCode'])
+			chgSubject = self.subjectLookup.get(les['changes']['newSubjectCode'])
 			vptype = vptype | PlanEntry.vptype.SUBJECT
 
 		# Supply teacher (yes, DaVinci assumes, that there are multiple teachers - in theory not wrong).
 		chgTeacher = None
 		if 'newTeacherCodes' in les['changes'].keys():
 			for t in les['changes']['newTeacherCodes']:
-				chgTeacher = Teacher.objects.get(code=t)
+				chgTeacher = self.teacherLookup.get(t)
 				vptype = vptype | PlanEntry.vptype.TEACHER
 				break
 
@@ -202,46 +849,10 @@ class DavinciJsonParser(BaseParser):
 				vptype = vptype | PlanEntry.vptype.MOVED_TO
 				# FIXME: lets extract the details.
 				if 'caption' in les['changes'].keys():
-					regex_moved_to = app_settings.get(app_settings.PLAN_PARSER_REGEX_MOVED_TO)
-					if regex_moved_to is not None:
-						matchMove = re.compile(regex_moved_to)
-						r = matchMove.match(les['changes']['caption'])
-						if r is not None:
-							now = datetime(
-								entryDates[0].year,
-								entryDates[0].month,
-								entryDates[0].day,
-								startTime.hour,
-								startTime.minute
-							)
-							startHour = r.group('startHour')
-							for k,f in self.timeframes.items():
-								if f == int(startHour):
-									startHour = datetime.strptime(k, '%H%M').time()
-									break
-							if not hasattr(startHour, 'hour'):
-								startHour = datetime.now().time()
-							future = datetime(
-								now.year,
-								int(r.group('month')),
-								int(r.group('day')),
-								startHour.hour,
-								startHour.minute
-							)
-							# if the future is already the past, we have to exchange:
-							if future < now:
-								past = future
-								future = past.replace(year=past.year + 1)
-							else:
-								past = future.replace(year=future.year - 1)
-							# depending on whats close to original date, we use that.
-							if (future - now) <= (now - past):
-								chgDate = future
-							else:
-								chgDate = past
-							# the hour
-							chgHour = int(r.group('startHour'))
-							# now the times. ==> skipped @ FIXME!
+					moved = self.captions.resolveMovedTo(les['changes']['caption'], entryDates[0], startTime)
+					if moved is not None:
+						chgDate, chgHour = moved
+						# now the times. ==> skipped @ FIXME!
 			elif les['changes']['cancelled'] == 'classFree' or les['changes']['cancelled'] == 'lessonCancelled':
 				# possibility 2: cancelled.
 				vptype = vptype | PlanEntry.vptype.FREE
@@ -249,56 +860,29 @@ class DavinciJsonParser(BaseParser):
 		# This entry could also be the inverse one to the above one (we need to parse the info field).
 		if 'caption' in les['changes'].keys() and (vptype & PlanEntry.vptype.FREE) != PlanEntry.vptype.FREE \
 			and (vptype & PlanEntry.vptype.MOVED_TO) != PlanEntry.vptype.MOVED_TO:
-			regex_moved_from = app_settings.get(app_settings.PLAN_PARSER_REGEX_MOVED_FROM)
-			if regex_moved_from is not None:
-				matchMove = re.compile(regex_moved_from)
-				r = matchMove.match(les['changes']['caption'])
-				if r is not None:
-					vptype = vptype | PlanEntry.vptype.MOVED_FROM
-					now = datetime(
-						entryDates[0].year,
-						entryDates[0].month,
-						entryDates[0].day,
-						startTime.hour,
-						startTime.minute
-					)
-					startHour = r.group('startHour')
-					for k,f in self.timeframes.items():
-						if f == int(startHour):
-							startHour = datetime.strptime(k, '%H%M').time()
-							break
-					if not hasattr(startHour, 'hour'):
-						startHour = datetime.now().time()
-					future = datetime(
-						now.year,
-						int(r.group('month')),
-						int(r.group('day')),
-						startHour.hour,
-						startHour.minute
-					)
-					# if the future is already the past, we have to exchange:
-					if future < now:
-						past = future
-						future = past.replace(year=past.year + 1)
-					else:
-						past = future.replace(year=future.year - 1)
-					# depending on whats close to original date, we use that.
-					if (future - now) <= (now - past):
-						chgDate = future
-					else:
-						chgDate = past
-					# the hour
-					chgHour = int(r.group('startHour'))
-					# now the times. ==> skipped @ FIXME!
+			moved = self.captions.resolveMovedFrom(les['changes']['caption'], entryDates[0], startTime)
+			if moved is not None:
+				vptype = vptype | PlanEntry.vptype.MOVED_FROM
+				chgDate, chgHour = moved
+				# now the times. ==> skipped @ FIXME!
 		# some notes?
 		if 'information' in les['changes']:
 			note = les['changes']['information']
 
+		# the fingerprint of the change (used by delta uploads).
+		fingerprint = hashlib.sha1(json.dumps(
+			[les['changes'], les['startTime'], les['endTime'], les['courseRef'], les['teacherCodes'], les['roomCodes']],
+			sort_keys=True, default=str
+		).encode('utf-8')).hexdigest()
+
 		# finally create the records (for every day!)
 		records = []
 		for grade in classes:
-			gradeObj = Grade.objects.get(code=grade)
+			gradeObj = self.gradeLookup.get(grade)
 			for day in entryDates:
+				lessonKey = hashlib.sha1(
+					('%s|%s|%s' % (les.get('lessonRef'), day.isoformat(), grade)).encode('utf-8')
+				).hexdigest()
 				p = PlanEntry(
 					header=self.plan,
 					day=day,
@@ -316,7 +900,9 @@ class DavinciJsonParser(BaseParser):
 					supplyTimeStart=chgTimeStart,
 					supplyTimeEnd=chgTimeEnd,
 					note=note,
-					vptype=vptype
+					vptype=vptype,
+					lessonKey=lessonKey,
+					fingerprint=fingerprint
 				)
 				records.append(p)
 
@@ -325,60 +911,106 @@ class DavinciJsonParser(BaseParser):
 	def parseTeachers(self, planContent):
 		"""Parses all teachers"""
 		# load the teacher first (to have a proper connection).
+		records = OrderedDict()
+		# teachers linked to a user are displayed with the name of the user.
+		linkedNames = Teacher.getLinkedNames()
 		for tf in planContent['teachers']:
-			t = Teacher.objects.get_or_create(id=tf['id'], code=tf['code'])
-			t = t[0]
-			t.first_name = tf['firstName'] if 'firstName' in tf else None
-			t.last_name = tf['lastName'] if 'lastName' in tf else None
-			t.save()
+			pk = uuid.UUID(tf['id'])
+			record = {
+				'code': tf['code'],
+				'first_name': tf['firstName'] if 'firstName' in tf else None,
+				'last_name': tf['lastName'] if 'lastName' in tf else None,
+			}
+			fullName = linkedNames.get(pk)
+			if fullName is None and record['first_name'] is not None and record['last_name'] is not None:
+				fullName = '%s %s' % (record['first_name'], record['last_name'])
+			record.update(Teacher.displayNames(record['code'], fullName, self.settings))
+			records[pk] = record
+		self.teachers = self._sync.sync('teachers', Teacher, records)
 
 	def parseSubjects(self, planContent):
 		"""Parses all subjects from file"""
 		# All subjects
+		records = OrderedDict()
 		for tf in planContent['subjects']:
-			Subject.objects.get_or_create(id=tf['id'], code=tf['code'], fullname=tf['description'] if 'description' in tf else tf['code'])
+			record = {
+				'code': tf['code'],
+				'fullname': tf['description'] if 'description' in tf else tf['code'],
+			}
+			record.update(Subject.displayNames(record['code'], record['fullname'], self.settings))
+			records[uuid.UUID(tf['id'])] = record
+		self.subjects = self._sync.sync('subjects', Subject, records)
 
 	def parseDivisions(self, planContent):
 		"""Parses all divisions from file"""
 		# All divisions
+		records = OrderedDict()
 		for tf in planContent['teams']:
-			Division.objects.get_or_create(
-				id=tf['id'], code=tf['code'], name=tf['description'] if 'description' in tf else tf['code']
-			)
+			records[uuid.UUID(tf['id'])] = {
+				'code': tf['code'],
+				'name': tf['description'] if 'description' in tf else tf['code'],
+			}
+		self.divisions = self._sync.sync('divisions', Division, records)
 
 	def parseCourses(self, planContent):
 		"""Parses all courses from file"""
 		# All courses (teacher must be learned later).
+		records = OrderedDict()
 		for tf in planContent['courses']:
 			# first get the subject.
-			subject = Subject.objects.get(id=tf['subjectRef'])
-			Course.objects.get_or_create(
-				id=tf['id'], schoolYear=self.schoolYear, subject=subject, name=tf['title']
-			)
+			subject = self.subjects.get(uuid.UUID(tf['subjectRef']))
+			if subject is None:
+				raise PlanParseException('Unknown subject %s for course %s' % (tf['subjectRef'], tf['id']))
+			records[uuid.UUID(tf['id'])] = {
+				'schoolYear_id': self.schoolYear.pk,
+				'subject_id': subject.pk,
+				'name': tf['title'],
+			}
+		self.courses = self._sync.sync('courses', Course, records)
 
 	def parseClasses(self, planContent):
 		"""Parses all classes from file"""
 		# All classes
+		records = OrderedDict()
 		for tf in planContent['classes']:
 			# find the division!
 			div = None
 			if 'teamRefs' in tf.keys():
 				for cl in tf['teamRefs']:
-					div = Division.objects.get(id=cl)
+					div = self.divisions.get(uuid.UUID(cl))
 					if div is not None:
 						break
-			Grade.objects.get_or_create(
-				id=tf['id'], code=tf['code'], division=div, schoolYear=self.schoolYear
-			)
+			records[uuid.UUID(tf['id'])] = {
+				'code': tf['code'],
+				'division_id': div.pk if div is not None else None,
+				'schoolYear_id': self.schoolYear.pk,
+			}
+		self.grades = self._sync.sync('classes', Grade, records)
+
+	def buildLookups(self):
+		"""Builds the lookup caches out of the synced master data."""
+		self.teacherLookup = LookupCache(
+			'teacher', dict((t.code, t) for t in self.teachers.values()), self.statistics
+		)
+		self.subjectLookup = LookupCache(
+			'subject', dict((s.code, s) for s in self.subjects.values()), self.statistics
+		)
+		self.courseLookup = LookupCache('course', self.courses, self.statistics, normalize=uuid.UUID)
+		self.gradeLookup = LookupCache(
+			'class', dict((g.code, g) for g in self.grades.values()), self.statistics
+		)
+		self._learnedCourses = []
 
 	def parseTimeFrames(self, planContent):
 		"""Parses timetable from file"""
 		# For the DaVinci plan, we first need to get the timetable in order to populate the 
 		# "hours" correctly.
 		self.timeframes = {}
+		self.captions = CaptionResolver(self.settings)
 		for tf in planContent['timeframes']:
 			# but only the standard one, not the duty one.
 			if tf['code'] == 'Standard':
 				for t in tf['timeslots']:
 					self.timeframes[t['startTime']] = int(t['label'])
+					self.captions.addTimeslot(t['startTime'], int(t['label']))
 
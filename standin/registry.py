@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8:ts=8:sw=8:si:sta:noet
+#
+# Standin plan as extension to Django framework.
+# Copyright (C) 2016 Friedrich-List-Schule Wiesbaden
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the 
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.signals import request_started, request_finished
+from django.db import transaction
+from django.db.models import Max
+from django.db.models.signals import post_save, post_delete
+from standin import settings as app_settings
+from standin.cache import getCache
+from standin.models import Plan, PlanChangelog, SchoolYear
+import datetime, threading
+
+# The pointer to the active plan and the current school year is kept in the
+# cache for PLAN_ACTIVE_TIMEOUT seconds. Changes invalidate it only in the
+# cache of the own process, so other processes see them once it expired (unless
+# the cache is shared). Within a request, it is read only once.
+ACTIVE_KEY = 'standin:active'
+PLAN_FIELDS = ('id', 'vpdtup', 'vpstand', 'vpactive', 'fingerprint')
+YEAR_FIELDS = ('id', 'start', 'end')
+
+_request = threading.local()
+
+def load():
+	"""Reads the pointer from the database."""
+	plan = Plan.objects.filter(vpactive=True).order_by('-vpdtup').values(*PLAN_FIELDS).first()
+	changed = None
+	if plan is not None:
+		changed = PlanChangelog.objects.filter(header_id=plan['id']).aggregate(Max('created'))['created__max']
+	today = datetime.date.today()
+	years = list(SchoolYear.objects.filter(start__lte=today, end__gte=today).values(*YEAR_FIELDS)[:2])
+	return {
+		'plan': plan,
+		'changed': changed,
+		# only an unambiguous school year is used.
+		'schoolYear': years[0] if len(years) == 1 else None,
+		'date': today,
+	}
+
+def getPointer():
+	"""Returns the pointer (a dictionary with plan, changed, schoolYear and date)."""
+	pointer = getattr(_request, 'pointer', None)
+	if pointer is not None:
+		return pointer
+
+	cache = getCache()
+	pointer = cache.get(ACTIVE_KEY)
+	# the school year can change over night.
+	if pointer is None or pointer['date'] != datetime.date.today():
+		pointer = load()
+		cache.set(ACTIVE_KEY, pointer, int(app_settings.snapshot().PLAN_ACTIVE_TIMEOUT))
+	if getattr(_request, 'active', False):
+		_request.pointer = pointer
+	return pointer
+
+def _instance(model, fields, values):
+	if values is None:
+		return None
+	# the other fields are deferred (and loaded on access).
+	return model.from_db(model.objects.db, list(fields), [values[f] for f in fields])
+
+def getActivePlan():
+	"""Returns the active plan (or None) without asking the database."""
+	return _instance(Plan, PLAN_FIELDS, getPointer()['plan'])
+
+def getPlanVersion():
+	"""Returns id, vpstand, vpdtup and the date of the last change of the active plan (or None)."""
+	pointer = getPointer()
+	if pointer['plan'] is None:
+		return None
+	version = dict(pointer['plan'])
+	version['changed'] = pointer['changed']
+	return version
+
+def getCurrentSchoolYear():
+	"""Returns the current school year (raises SchoolYear.DoesNotExist if there is none)."""
+	year = _instance(SchoolYear, YEAR_FIELDS, getPointer()['schoolYear'])
+	if year is None:
+		raise SchoolYear.DoesNotExist('No current school year defined.')
+	return year
+
+def invalidate(**kwargs):
+	"""Drops the pointer. It is read from the database on the next access."""
+	getCache().delete(ACTIVE_KEY)
+	_request.pointer = None
+
+def invalidateOnChange(sender, **kwargs):
+	invalidate()
+	# another process could have read the old state before the commit.
+	transaction.on_commit(invalidate)
+
+def _startRequest(**kwargs):
+	_request.pointer = None
+	_request.active = True
+
+def _finishRequest(**kwargs):
+	_request.pointer = None
+	_request.active = False
+
+for model in (Plan, PlanChangelog, SchoolYear):
+	post_save.connect(invalidateOnChange, sender=model, dispatch_uid='standin.registry.%s.save' % (model.__name__,))
+	post_delete.connect(invalidateOnChange, sender=model, dispatch_uid='standin.registry.%s.delete' % (model.__name__,))
+request_started.connect(_startRequest)
+request_finished.connect(_finishRequest)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8:ts=8:sw=8:si:sta:noet
+#
+# Standin plan as extension to Django framework.
+# Copyright (C) 2016 Friedrich-List-Schule Wiesbaden
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the 
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.db import transaction
+from django.utils import timezone
+from standin import settings as app_settings
+from standin.models import Plan, PlanEntry, PlanChangelog
+import time
+
+class RetentionReport:
+	"""Result of a compaction run."""
+
+	def __init__(self):
+		self.keptPlans = 0
+		self.plans = 0
+		self.entries = 0
+		self.changelogs = 0
+		self.seconds = 0.0
+
+	def __str__(self):
+		return 'Kept %d plans, removed %d plans, %d entries and %d changelogs in %.2f s' % (
+			self.keptPlans, self.plans, self.entries, self.changelogs, self.seconds
+		)
+
+def getRetainedPlans(keep=None, keepDaily=False):
+	"""Returns the ids of all plans to keep.
+
+	These are the n most recent plans, the active plan and - if requested -
+	the most recent plan of every day (according to the date of the data).
+	"""
+	if keep is None:
+		keep = int(app_settings.snapshot().PLAN_RETENTION_KEEP)
+
+	retained = set()
+	days = set()
+	# not the cached pointer of the registry (it can be stale in this process).
+	active = Plan.getActivePlan()
+	if active is not None:
+		retained.add(active.pk)
+
+	plans = Plan.objects.order_by('-vpdtup').values_list('id', 'vpstand')
+	for pos, (pk, vpstand) in enumerate(plans.iterator()):
+		if pos < keep:
+			retained.add(pk)
+		if keepDaily:
+			day = timezone.localtime(vpstand).date() if timezone.is_aware(vpstand) else vpstand.date()
+			if day not in days:
+				days.add(day)
+				retained.add(pk)
+
+	return retained
+
+def compactPlans(keep=None, keepDaily=False, batchSize=None):
+	"""Deletes all superseded plans (see getRetainedPlans).
+
+	The entries are deleted in chunks of batchSize, each chunk in its own
+	transaction, so the tables are never locked for long. The changelogs and
+	the plan itself are deleted at last. An interrupted run leaves a partly
+	deleted (superseded) plan behind, which is finished by the next run.
+	"""
+	if batchSize is None:
+		batchSize = int(app_settings.snapshot().PLAN_BULK_BATCH_SIZE)
+
+	report = RetentionReport()
+	start = time.time()
+	retained = getRetainedPlans(keep, keepDaily)
+	report.keptPlans = len(retained)
+	plans = list(Plan.objects.exclude(id__in=retained).values_list('id', flat=True))
+
+	for pk in plans:
+		# first the entries (as they are the most).
+		while True:
+			with transaction.atomic():
+				ids = list(PlanEntry.objects.filter(header_id=pk).values_list('id', flat=True)[:batchSize])
+				if len(ids) <= 0:
+					break
+				PlanEntry.objects.filter(id__in=ids).delete()
+			report.entries += len(ids)
+
+		with transaction.atomic():
+			report.changelogs += PlanChangelog.objects.filter(header_id=pk).delete()[0]
+			Plan.objects.filter(id=pk).delete()
+		report.plans += 1
+
+	report.seconds = time.time() - start
+	return report
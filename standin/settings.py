@@ -19,8 +19,10 @@
 
 # Contains app specific settings!
 from django.conf import settings
+from django.core.signals import request_started
 from django.db.models import BooleanField
 from django.utils.translation import ugettext_lazy as _
+import threading
 
 PLAN_FILES_ENCODING = getattr(settings, 'PLAN_FILES_ENCODING', 'utf-8')
 PLAN_PARSER_MODEL = getattr(settings, 'PLAN_PARSER_MODEL', 'standin.parser.DavinciJsonParser')
@@ -34,32 +36,144 @@ PLAN_PARSER_REGEX_MOVED_FROM = getattr(
 	'PLAN_PARSER_REGEX_MOVED_TO', 
 	'^Von (?P<day>[0-9]{1,2})\.(?P<month>[0-9]{1,2})\. (?P<weekday>[a-zA-Z]{2}) (?P<startHour>[0-9]{1,2})(-(?P<endHour>[0-9]{1,2}))? verschoben$'
 )
+# Number of rows written with one query when importing a plan.
+PLAN_BULK_BATCH_SIZE = getattr(settings, 'PLAN_BULK_BATCH_SIZE', 500)
+# Uncompressed files larger than this (in bytes) are streamed instead of read at once
+# (if the parser supports it).
+PLAN_STREAMING_THRESHOLD = getattr(settings, 'PLAN_STREAMING_THRESHOLD', 5 * 1024 * 1024)
+# Measure the peak memory of every stage of a parse run with tracemalloc. This slows
+# down the parser and all other threads of the process, so it is meant for analysis.
+PLAN_PARSE_TRACE_MEMORY = getattr(settings, 'PLAN_PARSE_TRACE_MEMORY', False)
+# Update the active plan with the differences of an upload instead of creating a new plan.
+PLAN_DELTA_UPLOADS = getattr(settings, 'PLAN_DELTA_UPLOADS', False)
+# Number of most recent plans kept by the compaction (standin_compact).
+PLAN_RETENTION_KEEP = getattr(settings, 'PLAN_RETENTION_KEEP', 10)
+# Cache (alias of settings.CACHES) and timeout (seconds) of the rendered plans.
+PLAN_CACHE_ALIAS = getattr(settings, 'PLAN_CACHE_ALIAS', 'default')
+PLAN_CACHE_TIMEOUT = getattr(settings, 'PLAN_CACHE_TIMEOUT', 3600)
+# Seconds the pointer to the active plan is cached. Uploads invalidate it at once
+# in the cache of the uploading process, so with a cache shared by all processes
+# (e.g. memcached, redis or the database) the pages are up to date immediately;
+# with a cache per process (local memory, the default) after at most this time.
+PLAN_ACTIVE_TIMEOUT = getattr(settings, 'PLAN_ACTIVE_TIMEOUT', 10)
+# How uploads from the admin are processed: 'thread' (queued and parsed by a thread
+# of the web server), 'command' (queued and parsed by the standin_ingest command)
+# or 'sync' (parsed within the upload request).
+PLAN_INGEST_MODE = getattr(settings, 'PLAN_INGEST_MODE', 'thread')
+# Seconds without sign of life after which a running upload is failed (its worker died).
+PLAN_INGEST_TIMEOUT = getattr(settings, 'PLAN_INGEST_TIMEOUT', 300)
 PLAN_PUPIL_TEACHER_FULLNAME = getattr(settings, 'PLAN_PUPIL_TEACHER_FULLNAME', False)
 PLAN_PUPIL_TEACHER_SHORTCUT = getattr(settings, 'PLAN_PUPIL_TEACHER_SHORTCUT', False)
 PLAN_PUPIL_SUBJECT_FULLNAME = getattr(settings, 'PLAN_PUPIL_SUBJECT_FULLNAME', False)
 PLAN_PUPIL_SUBJECT_SHORTCUT = getattr(settings, 'PLAN_PUPIL_SUBJECT_SHORTCUT', False)
 
+# Names of all settings (available as attributes of a Snapshot).
+SETTINGS = (
+	'PLAN_FILES_ENCODING', 'PLAN_PARSER_MODEL', 'PLAN_PARSER_REGEX_MOVED_TO', 'PLAN_PARSER_REGEX_MOVED_FROM',
+	'PLAN_BULK_BATCH_SIZE', 'PLAN_STREAMING_THRESHOLD', 'PLAN_PARSE_TRACE_MEMORY', 'PLAN_DELTA_UPLOADS',
+	'PLAN_RETENTION_KEEP',
+	'PLAN_CACHE_ALIAS', 'PLAN_CACHE_TIMEOUT', 'PLAN_ACTIVE_TIMEOUT', 'PLAN_INGEST_MODE', 'PLAN_INGEST_TIMEOUT',
+	'PLAN_PUPIL_TEACHER_FULLNAME', 'PLAN_PUPIL_TEACHER_SHORTCUT', 'PLAN_PUPIL_SUBJECT_FULLNAME',
+	'PLAN_PUPIL_SUBJECT_SHORTCUT'
+)
+
+# Counts the lookups of preferences (per thread), see countLookups().
+_lookups = threading.local()
+
 def get(name):
+	_lookups.count = getattr(_lookups, 'count', 0) + 1
 	if hasattr(name, 'get_value'):
 		return getattr(name, 'get_value')()
 	else:
 		return name
 
+class LookupCounter:
+	"""Counts the preference lookups of the current thread while it is active."""
+
+	def __enter__(self):
+		self._start = getattr(_lookups, 'count', 0)
+		self.count = 0
+		return self
+
+	def __exit__(self, *args):
+		self.count = getattr(_lookups, 'count', 0) - self._start
+
+def countLookups():
+	return LookupCounter()
+
+class Snapshot:
+	"""Values of the settings at one point of time.
+
+	With django-siteprefs, every get() can ask the preference store. The
+	snapshot looks up every setting only once (on first access).
+	"""
+
+	def __getattr__(self, name):
+		if name not in SETTINGS:
+			raise AttributeError(name)
+		value = get(globals()[name])
+		setattr(self, name, value)
+		return value
+
+# The snapshot of the current thread (so concurrent requests do not renew it for
+# each other) and the generation of the preferences it was taken of.
+_snapshot = threading.local()
+_generation = 0
+
+def snapshot():
+	"""Returns the current snapshot (renewed for every request and whenever preferences change)."""
+	current = getattr(_snapshot, 'current', None)
+	if current is None or _snapshot.generation != _generation:
+		current = _snapshot.current = Snapshot()
+		_snapshot.generation = _generation
+	return current
+
+def invalidate(**kwargs):
+	"""Drops the snapshot of the current thread."""
+	_snapshot.current = None
+
+def invalidateAll(**kwargs):
+	"""Drops the snapshots of all threads (e.g. after the preferences changed)."""
+	global _generation
+	_generation += 1
+	invalidate()
+
+request_started.connect(invalidate)
+
 # to allow to edit it online:
 # To be sure our app is still functional without django-siteprefs
 # we use this try-except block.
 try:
 	from siteprefs.toolbox import patch_locals, register_prefs, pref_group, pref
+	from siteprefs.signals import prefs_save
+	prefs_save.connect(invalidateAll)
 	patch_locals()  # This bootstrap is required before `register_prefs` step.
 
 	# And that's how we expose our options to Admin.
 	register_prefs(
 		pref_group(
 			_('Standin parser settings'), (
-				PLAN_FILES_ENCODING, PLAN_PARSER_MODEL, PLAN_PARSER_REGEX_MOVED_TO, PLAN_PARSER_REGEX_MOVED_FROM
+				PLAN_FILES_ENCODING, PLAN_PARSER_MODEL, PLAN_PARSER_REGEX_MOVED_TO, PLAN_PARSER_REGEX_MOVED_FROM,
+				PLAN_BULK_BATCH_SIZE, PLAN_STREAMING_THRESHOLD, PLAN_RETENTION_KEEP, PLAN_INGEST_MODE, PLAN_INGEST_TIMEOUT
 			),
 			static=False
 		),
+		pref(
+			PLAN_DELTA_UPLOADS,
+			field=BooleanField(),
+			static=False,
+			verbose_name=_('Delta uploads'),
+			help_text=_('Only the differences of an upload are written to the active plan instead of creating a new plan.'),
+			category=_('Standin parser settings')
+		),
+		pref(
+			PLAN_PARSE_TRACE_MEMORY,
+			field=BooleanField(),
+			static=False,
+			verbose_name=_('Trace memory'),
+			help_text=_('Measures the peak memory of every stage of an upload (slows down the upload and the web server).'),
+			category=_('Standin parser settings')
+		),
 		pref(
 			PLAN_PUPIL_TEACHER_FULLNAME,
 			field=BooleanField(),
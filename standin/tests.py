@@ -11,13 +11,963 @@
 #
 # This program is distributed in the hope that it will be useful,
 # but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the 
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, connections, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone, translation
+from standin.models import SchoolYear, Teacher, Subject, Division, Course, Grade, Plan, PlanEntry, PlanChangelog, PlanJob, refreshAllDisplayNames
+from standin.retention import compactPlans
+from standin.watch import DropFolderWatcher
+from standin import cache, ingest, registry, views
+from standin.helpers import PlanIterer, PlanRow
+from standin import settings as app_settings
+from unittest import mock
+from standin.parser import DavinciJsonParser, PlanParseException, CaptionResolver, parseDate, parseTime, ijson, plan_parsed
+from unittest import skipIf
+import codecs, datetime, gzip, io, json, os, shutil, tempfile, threading, time, tracemalloc, uuid
 
-# Create your tests here.
+def davinciExport(teachers=3, classes=2, lessons=4, stamp='20160125 0730'):
+	"""Builds a small DaVinci export (as dict) for testing purposes."""
+	ns = uuid.UUID('4a0bd1c4-0f0a-4b4c-9d0c-7c1a8f0e2b11')
+	ref = lambda kind, n: str(uuid.uuid5(ns, '%s-%d' % (kind, n)))
+	result = {
+		'teachers': [
+			{'id': ref('teacher', i), 'code': 'T%d' % (i,), 'firstName': 'First%d' % (i,), 'lastName': 'Last%d' % (i,)}
+			for i in range(teachers)
+		],
+		'subjects': [
+			{'id': ref('subject', i), 'code': 'S%d' % (i,), 'description': 'Subject %d' % (i,)}
+			for i in range(teachers)
+		],
+		'teams': [{'id': ref('team', 0), 'code': 'BS', 'description': 'Berufsschule'}],
+		'courses': [
+			{'id': ref('course', i), 'subjectRef': ref('subject', i), 'title': 'C%d' % (i,)}
+			for i in range(teachers)
+		],
+		'classes': [
+			{'id': ref('class', i), 'code': '10%s' % (chr(ord('A') + i),), 'teamRefs': [ref('team', 0)]}
+			for i in range(classes)
+		],
+		'timeframes': [{'code': 'Standard', 'timeslots': [
+			{'startTime': '%02d00' % (7 + i,), 'label': str(i + 1)} for i in range(10)
+		]}],
+		'displaySchedule': {'lessonTimes': []},
+	}
+	for i in range(lessons):
+		hour = i % 10
+		result['displaySchedule']['lessonTimes'].append({
+			'lessonRef': ref('lesson', i),
+			'dates': ['20160125'],
+			'startTime': '%02d00' % (7 + hour,),
+			'endTime': '%02d45' % (7 + hour,),
+			'teacherCodes': ['T%d' % (i % teachers,)],
+			'courseRef': ref('course', i % teachers),
+			'classCodes': ['10%s' % (chr(ord('A') + (i // 10) % classes),)],
+			'roomCodes': ['R%d' % (i,)],
+			'changes': {'cancelled': 'classFree'},
+		})
+	return {'about': {'serverTimeStamp': stamp}, 'result': result}
 
+def exportFile(export):
+	return io.BytesIO(json.dumps(export).encode('utf-8'))
+
+class ParserTestCase(TestCase):
+
+	def setUp(self):
+		today = datetime.date.today()
+		SchoolYear.objects.create(start=today - datetime.timedelta(days=100), end=today + datetime.timedelta(days=100))
+
+	def parse(self, export, **kwargs):
+		parser = DavinciJsonParser(exportFile(export), **kwargs)
+		parser.parse()
+		return parser
+
+	def parseAndCommit(self, export, **kwargs):
+		"""Parses and runs the callbacks waiting for the commit (a TestCase never commits)."""
+		callbacks = []
+		with mock.patch.object(transaction, 'on_commit', callbacks.append):
+			parser = self.parse(export, **kwargs)
+		for callback in callbacks:
+			callback()
+		return parser
+
+class MasterDataSyncTest(ParserTestCase):
+
+	def test_initial_import(self):
+		parser = self.parse(davinciExport(teachers=5, classes=3))
+		self.assertEqual(Teacher.objects.count(), 5)
+		self.assertEqual(Subject.objects.count(), 5)
+		self.assertEqual(Division.objects.count(), 1)
+		self.assertEqual(Course.objects.count(), 5)
+		self.assertEqual(Grade.objects.count(), 3)
+		stage = parser.statistics.stage('teachers')
+		self.assertEqual((stage.rows, stage.created, stage.updated), (5, 5, 0))
+
+	def test_query_count_is_independent_of_rows(self):
+		small = self.parse(davinciExport(teachers=2)).statistics.stage('teachers').queries
+		Teacher.objects.all().delete()
+		large = self.parse(davinciExport(teachers=50)).statistics.stage('teachers').queries
+		self.assertEqual(small, large)
+
+	def test_queries_are_counted_without_query_log(self):
+		# a full query log of django must not influence the figures.
+		connection.queries_log.extend([{}] * connection.queries_limit)
+		self.addCleanup(connection.queries_log.clear)
+		stage = self.parse(davinciExport(teachers=2)).statistics.stage('teachers')
+		self.assertGreater(stage.queries, 0)
+		self.assertFalse(connection.force_debug_cursor)
+		self.assertNotIn('make_cursor', connections['default'].__dict__)
+
+	def test_only_changes_are_written(self):
+		export = davinciExport(teachers=4)
+		self.parse(export)
+		export['result']['teachers'][1]['lastName'] = 'Changed'
+		stage = self.parse(export).statistics.stage('teachers')
+		self.assertEqual((stage.created, stage.updated), (0, 1))
+		self.assertEqual(Teacher.objects.get(code='T1').last_name, 'Changed')
+
+class LookupCacheTest(ParserTestCase):
+
+	def test_lessons_are_resolved_from_cache(self):
+		parser = self.parse(davinciExport(teachers=3, classes=2, lessons=30))
+		self.assertEqual(PlanEntry.objects.count(), 30)
+		self.assertEqual(parser.statistics.lookup('class').hits, 30)
+		self.assertEqual(parser.statistics.lookup('teacher').misses, 0)
+		self.assertIsNotNone(Course.objects.get(name='C1').teacher)
+
+	def test_unknown_code_raises(self):
+		export = davinciExport()
+		export['result']['displaySchedule']['lessonTimes'][0]['classCodes'] = ['unknown']
+		with self.assertRaises(PlanParseException):
+			self.parse(export)
+
+class PlanWriteTest(ParserTestCase):
+
+	def test_plan_is_written_and_activated(self):
+		parser = self.parse(davinciExport(lessons=30))
+		self.assertTrue(Plan.objects.get().vpactive)
+		self.assertEqual(parser.plan.entries.count(), 30)
+		self.assertEqual(parser.statistics.stage('write').created, 30)
+
+	def test_failed_upload_leaves_nothing_behind(self):
+		export = davinciExport(lessons=30)
+		export['result']['displaySchedule']['lessonTimes'][20]['teacherCodes'] = ['unknown']
+		with self.assertRaises(PlanParseException):
+			self.parse(export)
+		self.assertEqual(Plan.objects.count(), 0)
+		self.assertEqual(PlanEntry.objects.count(), 0)
+		self.assertEqual(Teacher.objects.count(), 0)
+
+@skipIf(ijson is None, 'ijson is not installed')
+class StreamingParserTest(ParserTestCase):
+
+	def test_streaming_equals_reading(self):
+		export = davinciExport(lessons=25)
+		self.parse(export)
+		expected = list(PlanEntry.objects.order_by('hour', 'room').values_list('hour', 'room', 'grade__code'))
+		fingerprint = Plan.objects.get().fingerprint
+		Plan.objects.all().delete()
+		parser = self.parse(export, streaming=True)
+		self.assertEqual(
+			list(parser.plan.entries.order_by('hour', 'room').values_list('hour', 'room', 'grade__code')),
+			expected
+		)
+		self.assertEqual(parser.plan.fingerprint, fingerprint)
+
+	def test_byte_order_mark(self):
+		content = codecs.BOM_UTF8 + exportFile(davinciExport()).read()
+		parser = DavinciJsonParser(io.BytesIO(content), streaming=True)
+		parser.parse()
+		self.assertEqual(parser.plan.entries.count(), 4)
+
+class CaptionResolverTest(TestCase):
+
+	def setUp(self):
+		self.resolver = CaptionResolver()
+		for i in range(10):
+			self.resolver.addTimeslot('%02d00' % (7 + i,), i + 1)
+
+	def test_moved_to(self):
+		day = datetime.date(2016, 1, 25)
+		self.assertEqual(
+			self.resolver.resolveMovedTo('Auf 27.1. Mi 3-4 verschoben', day, datetime.time(7, 0)),
+			(datetime.date(2016, 1, 27), 3)
+		)
+		# around new year, the closest date wins.
+		self.assertEqual(
+			self.resolver.resolveMovedTo('Auf 2.1. Sa 1 verschoben', datetime.date(2015, 12, 30), datetime.time(7, 0)),
+			(datetime.date(2016, 1, 2), 1)
+		)
+		self.assertIsNone(self.resolver.resolveMovedTo('Vertretung', day, datetime.time(7, 0)))
+
+	def test_work_per_caption(self):
+		"""Expressions are compiled once per parse, dates and times are parsed once (not per caption)."""
+		captions = ['Auf %d.2. Mo %d verschoben' % (1 + i % 28, 1 + i % 10) for i in range(200)]
+		parseDate.cache_clear()
+		parseTime.cache_clear()
+		with mock.patch('standin.parser.re.compile', side_effect=AssertionError('compiled per caption')):
+			for c in captions:
+				self.assertIsNotNone(self.resolver.resolveMovedTo(c, parseDate('20160125'), parseTime('0700')))
+		self.assertEqual(parseDate.cache_info().misses, 1)
+		self.assertEqual(parseTime.cache_info().misses, 1)
+
+class DeltaUploadTest(ParserTestCase):
+
+	def test_only_differences_are_written(self):
+		export = davinciExport(lessons=20)
+		first = self.parse(export, delta=True)
+		self.assertEqual(first.changelog.inserted, 20)
+
+		lessons = export['result']['displaySchedule']['lessonTimes']
+		lessons[3]['changes'] = {'cancelled': 'lessonCancelled', 'information': 'Exam'}
+		del(lessons[5])
+		export['about']['serverTimeStamp'] = '20160125 0745'
+		parser = self.parse(export, delta=True)
+
+		self.assertEqual(parser.plan.pk, first.plan.pk)
+		self.assertEqual(Plan.objects.count(), 1)
+		self.assertEqual(parser.plan.entries.count(), 19)
+		self.assertEqual(parser.plan.entries.get(hour=4, grade__code='10A').note, 'Exam')
+		stage = parser.statistics.stage('write')
+		self.assertEqual((stage.created, stage.updated, stage.deleted), (0, 1, 1))
+		changelog = PlanChangelog.objects.latest()
+		self.assertEqual(changelog.getChanges()['updated'], [['2016-01-25', '10A', 4]])
+		self.assertEqual(changelog.getChanges()['removed'], [['2016-01-25', '10A', 6]])
+
+	def test_lesson_twice_a_day(self):
+		export = davinciExport(lessons=4)
+		lessons = export['result']['displaySchedule']['lessonTimes']
+		lessons[2]['lessonRef'] = lessons[1]['lessonRef']
+		self.parse(export, delta=True)
+		for stamp in ('0745', '0800', '0815'):
+			lessons[1]['changes'] = {'information': stamp}
+			export['about']['serverTimeStamp'] = '20160125 %s' % (stamp,)
+			parser = self.parse(export, delta=True)
+			self.assertEqual(parser.plan.entries.count(), 4)
+			stage = parser.statistics.stage('write')
+			self.assertEqual((stage.created, stage.updated, stage.deleted), (0, 1, 0))
+		self.assertEqual(list(parser.plan.entries.order_by('hour').values_list('hour', 'note')), [
+			(1, None), (2, '0815'), (3, None), (4, None)
+		])
+
+	def test_full_upload_without_delta(self):
+		export = davinciExport()
+		self.parse(export)
+		export['result']['displaySchedule']['lessonTimes'][0]['roomCodes'] = ['R99']
+		parser = self.parse(export, delta=False)
+		self.assertEqual(Plan.objects.count(), 2)
+		self.assertIsNone(parser.changelog)
+
+class ParseStatisticsTest(ParserTestCase):
+
+	def test_statistics_are_stored_and_sent(self):
+		received = []
+		receiver = lambda sender, statistics, **kwargs: received.append(statistics)
+		plan_parsed.connect(receiver)
+		self.addCleanup(plan_parsed.disconnect, receiver)
+		parser = self.parse(davinciExport(lessons=30))
+
+		self.assertEqual(received, [parser.statistics])
+		stats = Plan.objects.get().getStatistics()
+		self.assertEqual(list(stats['stages'])[:3], ['decode', 'fingerprint', 'teachers'])
+		self.assertEqual(stats['stages']['changes']['rows'], 30)
+		self.assertEqual(stats['stages']['write']['created'], 30)
+		# the writes are nested in the changes, but counted only once.
+		self.assertEqual(stats['stages']['changes']['queries'], 0)
+		self.assertEqual(stats['queries'], sum(s['queries'] for s in stats['stages'].values()))
+		self.assertGreaterEqual(stats['seconds'] + 0.001, sum(s['seconds'] for s in stats['stages'].values()))
+		# the memory is traced only on request.
+		self.assertIsNone(stats['peakMemory'])
+		self.assertIsNone(stats['stages']['decode']['peakMemory'])
+
+	@mock.patch.object(app_settings, 'PLAN_PARSE_TRACE_MEMORY', True)
+	def test_peak_memory(self):
+		self.parse(davinciExport(lessons=30))
+		stats = Plan.objects.get().getStatistics()
+		# the memory is measured per stage (and not for the whole process).
+		self.assertGreater(stats['stages']['decode']['peakMemory'], 0)
+		self.assertEqual(stats['peakMemory'], max(s['peakMemory'] or 0 for s in stats['stages'].values()))
+		self.assertFalse(tracemalloc.is_tracing())
+
+class FingerprintTest(ParserTestCase):
+
+	def test_unchanged_upload_updates_time_stamp_only(self):
+		export = davinciExport(lessons=12, stamp='20160125 0700')
+		first = self.parse(export)
+		vpstand = Plan.objects.get().vpstand
+		# other time stamp and order, but the same content.
+		export['about']['serverTimeStamp'] = '20160125 0800'
+		export['result']['displaySchedule']['lessonTimes'].reverse()
+		parser = self.parse(export)
+		self.assertTrue(parser.unchanged)
+		self.assertEqual(parser.plan.pk, first.plan.pk)
+		self.assertEqual(Plan.objects.count(), 1)
+		self.assertEqual(PlanEntry.objects.count(), 12)
+		self.assertEqual(Plan.objects.get().vpstand - vpstand, datetime.timedelta(hours=1))
+		self.assertNotIn('write', parser.statistics.stages)
+
+	def test_changed_upload_creates_plan(self):
+		export = davinciExport(lessons=12)
+		self.parse(export)
+		export['result']['teachers'][0]['lastName'] = 'Changed'
+		parser = self.parse(export)
+		self.assertFalse(parser.unchanged)
+		self.assertEqual(Plan.objects.count(), 2)
+
+class RetentionTest(ParserTestCase):
+
+	def setUp(self):
+		super().setUp()
+		for stamp in ('20160124 0700', '20160124 0800', '20160125 0700', '20160125 0800'):
+			export = davinciExport(lessons=3, stamp=stamp)
+			export['result']['displaySchedule']['lessonTimes'][0]['roomCodes'] = [stamp]
+			self.parse(export)
+
+	def test_keep_most_recent(self):
+		newest = list(Plan.objects.order_by('vpdtup').values_list('id', flat=True))[2:]
+		report = compactPlans(keep=2, batchSize=2)
+		self.assertEqual((report.plans, report.entries), (2, 6))
+		self.assertEqual(list(Plan.objects.order_by('vpdtup').values_list('id', flat=True)), newest)
+		self.assertEqual(PlanEntry.objects.count(), 6)
+
+	def test_keep_daily(self):
+		compactPlans(keep=1, keepDaily=True)
+		self.assertEqual(Plan.objects.count(), 2)
+
+	def test_command(self):
+		out = io.StringIO()
+		call_command('standin_compact', keep=3, stdout=out)
+		self.assertIn('removed 1 plans', out.getvalue())
+
+	def test_interrupted_run(self):
+		calls = []
+		def failSecondPlan(*args, **kwargs):
+			calls.append(kwargs)
+			if len(calls) == 2:
+				raise DatabaseError('connection lost')
+			return PlanChangelog.objects.filter(*args, **kwargs)
+
+		# only the deletes of the compaction (the registry reads changelogs, too).
+		with mock.patch('standin.retention.PlanChangelog') as changelogs, self.assertRaises(DatabaseError):
+			changelogs.objects.filter.side_effect = failSecondPlan
+			compactPlans(keep=2, batchSize=2)
+		# the first plan is removed, the entries of the second one are committed, too.
+		self.assertEqual(Plan.objects.count(), 3)
+		self.assertEqual(PlanEntry.objects.count(), 6)
+		# the next run finishes the second plan.
+		self.assertEqual(compactPlans(keep=2).plans, 1)
+		self.assertEqual(Plan.objects.count(), 2)
+
+	def test_entry_batches_are_committed(self):
+		filterEntries = PlanEntry.objects.filter
+		deletes = []
+		def failSecondBatch(*args, **kwargs):
+			if 'id__in' in kwargs:
+				deletes.append(kwargs)
+				if len(deletes) == 2:
+					raise DatabaseError('connection lost')
+			return filterEntries(*args, **kwargs)
+
+		with mock.patch.object(PlanEntry.objects, 'filter', side_effect=failSecondBatch), \
+			self.assertRaises(DatabaseError):
+			compactPlans(keep=2, batchSize=2)
+		self.assertEqual(Plan.objects.count(), 4)
+		self.assertEqual(PlanEntry.objects.count(), 10)
+
+class IndexBenchmarkTest(TestCase):
+
+	def test_pupil_plan_uses_index(self):
+		out = io.StringIO()
+		call_command('standin_benchmark_indexes', entries=2000, plans=4, stdout=out)
+		withIndex, withoutIndex = out.getvalue().split('== Without indexes')
+		self.assertIn('standin_planentry_header_id_day_grade_id_hour', withIndex)
+		self.assertNotIn('standin_planentry_header_id_day_grade_id_hour', withoutIndex)
+		self.assertEqual(Plan.objects.count(), 0)
+
+	def test_requires_transactional_ddl(self):
+		with mock.patch.object(connections['default'].features, 'can_rollback_ddl', False), \
+			self.assertRaises(CommandError):
+			call_command('standin_benchmark_indexes', entries=10, plans=1, stdout=io.StringIO())
+		self.assertEqual(Plan.objects.count(), 0)
+
+class PupilViewTest(ParserTestCase):
+
+	def countQueries(self, lessons):
+		Plan.objects.all().delete()
+		export = davinciExport(teachers=5, classes=3, lessons=lessons)
+		for i, les in enumerate(export['result']['displaySchedule']['lessonTimes']):
+			les['changes'] = {'newTeacherCodes': ['T%d' % ((i + 1) % 5,)], 'newSubjectCode': 'S%d' % (i % 5,)}
+		self.parse(export)
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.get('/standin/')
+		self.assertEqual(response.status_code, 200)
+		self.assertContains(response, 'T1')
+		return len(queries)
+
+	def test_constant_number_of_queries(self):
+		self.assertEqual(self.countQueries(5), self.countQueries(60))
+
+	def countLookups(self, lessons):
+		Plan.objects.all().delete()
+		self.parse(davinciExport(teachers=5, classes=3, lessons=lessons))
+		with app_settings.countLookups() as lookups:
+			self.client.get('/standin/')
+		return lookups.count
+
+	def test_constant_number_of_preference_lookups(self):
+		lookups = self.countLookups(5)
+		self.assertEqual(lookups, self.countLookups(60))
+		self.assertLessEqual(lookups, len(app_settings.SETTINGS))
+
+class SettingsSnapshotTest(TestCase):
+
+	def inThread(self, func):
+		result = []
+		thread = threading.Thread(target=lambda: result.append(func()))
+		thread.start()
+		thread.join()
+		return result[0]
+
+	def test_snapshot_per_thread(self):
+		current = app_settings.snapshot()
+		# another request (thread) does not renew the snapshot of this one.
+		self.assertIsNot(self.inThread(app_settings.snapshot), current)
+		self.inThread(app_settings.invalidate)
+		self.assertIs(app_settings.snapshot(), current)
+		# changed preferences renew the snapshots of all threads.
+		self.inThread(app_settings.invalidateAll)
+		self.assertIsNot(app_settings.snapshot(), current)
+
+class PupilCacheTest(ParserTestCase):
+
+	def test_page_is_cached_until_next_upload(self):
+		export = davinciExport(lessons=12)
+		self.parse(export)
+		self.client.get('/standin/')
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.get('/standin/')
+		# the active plan is known from the registry.
+		self.assertEqual(len(queries), 0)
+		self.assertContains(response, 'R11')
+
+		export['result']['displaySchedule']['lessonTimes'][11]['roomCodes'] = ['R99']
+		self.parse(export)
+		response = self.client.get('/standin/')
+		self.assertContains(response, 'R99')
+
+	def test_grouped_plan_is_cached(self):
+		self.parse(davinciExport(lessons=12))
+		plan = Plan.objects.latest()
+		cache.getPupilPlan(plan)
+		with CaptureQueriesContext(connection) as queries:
+			days = list(cache.getPupilPlan(plan))
+		self.assertEqual(len(queries), 0)
+		self.assertEqual(sum(len(list(grade)) for grade in days[0]), 12)
+
+class RegistryTest(ParserTestCase):
+
+	def test_active_plan_and_school_year(self):
+		self.assertIsNone(registry.getActivePlan())
+		self.assertEqual(self.client.get('/standin/').status_code, 200)
+		first = self.parse(davinciExport(lessons=2)).plan
+		self.assertEqual(registry.getActivePlan().pk, first.pk)
+
+		export = davinciExport(lessons=3)
+		self.parse(export)
+		# the parse invalidated the pointer, it is read once.
+		registry.getActivePlan()
+		with CaptureQueriesContext(connection) as queries:
+			plan = registry.getActivePlan()
+			year = registry.getCurrentSchoolYear()
+		self.assertEqual(len(queries), 0)
+		self.assertEqual(plan.pk, Plan.objects.filter(vpactive=True).latest().pk)
+		self.assertEqual(year.pk, SchoolYear.objects.get().pk)
+
+	def test_pointer_expires(self):
+		first = self.parse(davinciExport(lessons=2)).plan
+		second = Plan.objects.create(vpstand=first.vpstand)
+		self.assertEqual(registry.getActivePlan().pk, first.pk)
+		# activated by another process (no signals in this one).
+		Plan.objects.filter(pk=first.pk).update(vpactive=False)
+		Plan.objects.filter(pk=second.pk).update(vpactive=True)
+		self.assertEqual(registry.getActivePlan().pk, first.pk)
+		later = time.time() + app_settings.PLAN_ACTIVE_TIMEOUT + 1
+		with mock.patch('django.core.cache.backends.locmem.time.time', return_value=later):
+			self.assertEqual(registry.getActivePlan().pk, second.pk)
+
+	def test_uploads_ignore_stale_pointer(self):
+		export = davinciExport(lessons=2)
+		first = self.parse(export).plan
+		export['result']['displaySchedule']['lessonTimes'][0]['roomCodes'] = ['R99']
+		second = self.parse(export).plan
+		# another process still has the pointer to the first plan.
+		with mock.patch.object(registry, 'getActivePlan', return_value=first):
+			parser = self.parse(export, delta=True)
+		self.assertTrue(parser.unchanged)
+		self.assertEqual(parser.plan.pk, second.pk)
+		export['result']['displaySchedule']['lessonTimes'][0]['roomCodes'] = ['R98']
+		with mock.patch.object(registry, 'getActivePlan', return_value=first):
+			parser = self.parse(export, delta=True)
+		self.assertEqual(parser.plan.pk, second.pk)
+		self.assertEqual(list(Plan.objects.filter(vpactive=True).values_list('id', flat=True)), [second.pk])
+		self.assertEqual(set(first.entries.values_list('room', flat=True)), {'R0', 'R1'})
+		# the retention keeps the plan which is active in the database.
+		with mock.patch.object(registry, 'getActivePlan', return_value=first):
+			compactPlans(keep=0)
+		self.assertEqual(list(Plan.objects.values_list('id', flat=True)), [second.pk])
+
+	def test_no_school_year(self):
+		SchoolYear.objects.all().delete()
+		with self.assertRaises(SchoolYear.DoesNotExist):
+			registry.getCurrentSchoolYear()
+		with self.assertRaises(PlanParseException):
+			self.parse(davinciExport())
+
+class ActivationTest(ParserTestCase):
+
+	def test_single_active_plan(self):
+		export = davinciExport(lessons=2)
+		first = self.parse(export).plan
+		export['result']['displaySchedule']['lessonTimes'][0]['roomCodes'] = ['R99']
+		second = self.parse(export).plan
+		self.assertEqual(list(Plan.objects.filter(vpactive=True).values_list('id', flat=True)), [second.pk])
+		first.activate()
+		self.assertEqual(list(Plan.objects.filter(vpactive=True).values_list('id', flat=True)), [first.pk])
+		self.assertEqual(registry.getActivePlan().pk, first.pk)
+
+	def test_cache_is_prewarmed(self):
+		callbacks = []
+		with mock.patch.object(transaction, 'on_commit', callbacks.append):
+			parser = self.parse(davinciExport(lessons=12))
+		# the cache is filled once the plan is committed.
+		self.assertNotIn('prewarm', parser.statistics.stages)
+		for callback in callbacks:
+			callback()
+		self.assertIn('prewarm', parser.statistics.stages)
+		plan = registry.getActivePlan()
+		with CaptureQueriesContext(connection) as queries:
+			days = list(cache.getPupilPlan(plan))
+		self.assertEqual(len(queries), 0)
+		self.assertEqual(sum(len(list(grade)) for grade in days[0]), 12)
+		# and the pages are rendered already.
+		with mock.patch('standin.views.render_to_string', side_effect=AssertionError):
+			self.assertContains(self.client.get('/standin/'), 'R11')
+			self.assertContains(self.client.get('/standin/grade/10B/'), 'R11')
+
+class TeacherViewTest(ParserTestCase):
+
+	def setUp(self):
+		super().setUp()
+		export = davinciExport(teachers=3, lessons=6)
+		export['result']['displaySchedule']['lessonTimes'][1]['changes'] = {'newTeacherCodes': ['T0']}
+		self.plan = self.parse(export).plan
+		self.user = get_user_model().objects.create(username='t0', first_name='Linked', last_name='User')
+		self.teacher = Teacher.objects.get(code='T0')
+		self.teacher.user = self.user
+		self.teacher.save()
+
+	def test_own_courses_and_supplies(self):
+		rows = self.plan.getTeacherRows(self.teacher, self.plan.getNextDays())
+		self.assertEqual([r.hour for r in rows], [1, 2, 4])
+		self.assertEqual(rows[1].supplyTeacher.dspName, 'Linked User (T0)')
+		plan = cache.getTeacherPlan(self.plan, self.teacher)
+		with CaptureQueriesContext(connection) as queries:
+			cache.getTeacherPlan(self.plan, self.teacher)
+		self.assertEqual(len(queries), 0)
+		self.assertEqual(sum(len(list(grade)) for day in plan for grade in day), 3)
+
+	def test_view(self):
+		self.assertEqual(self.client.get('/standin/teacher/').status_code, 302)
+		self.client.force_login(self.user)
+		response = self.client.get('/standin/teacher/')
+		self.assertContains(response, 'standin_supply', count=1)
+		self.assertContains(response, 'R3')
+		self.assertNotContains(response, 'R2')
+
+class GradePlanTest(ParserTestCase):
+
+	def test_partitions_are_prewarmed(self):
+		# lessons 0-9 are in 10A, 10-19 in 10B.
+		self.parseAndCommit(davinciExport(classes=2, lessons=15))
+		plan = registry.getActivePlan()
+		with CaptureQueriesContext(connection) as queries, \
+			mock.patch.object(cache, 'getPupilPlan', side_effect=AssertionError):
+			gradePlan = cache.getGradePlan(plan, '10B')
+			unknown = cache.getGradePlan(plan, '13Z')
+		self.assertEqual(len(queries), 0)
+		self.assertEqual([g.grade.code for day in gradePlan for g in day], ['10B'])
+		self.assertEqual(sum(len(list(g)) for day in gradePlan for g in day), 5)
+		self.assertEqual(unknown.getDays(), gradePlan.getDays())
+		self.assertEqual(list(unknown)[0].day, gradePlan.getDays()[0])
+
+	def test_view(self):
+		# 10C exists, but has no entries.
+		self.parse(davinciExport(classes=3, lessons=15))
+		response = self.client.get('/standin/grade/10A/')
+		self.assertContains(response, 'R9')
+		self.assertNotContains(response, 'R10')
+		response = self.client.get('/standin/grade/10C/')
+		self.assertEqual(response.status_code, 200)
+		self.assertNotContains(response, 'R0')
+		with mock.patch.object(cache, 'getRenderedGradePlan') as rendered:
+			self.assertEqual(self.client.get('/standin/grade/13Z/').status_code, 404)
+		self.assertFalse(rendered.called)
+
+class PlanApiTest(ParserTestCase):
+
+	def setUp(self):
+		super().setUp()
+		export = davinciExport(teachers=3, classes=2, lessons=15)
+		export['result']['displaySchedule']['lessonTimes'][1]['changes'] = {'newTeacherCodes': ['T0']}
+		self.parse(export)
+
+	def get(self, **params):
+		response = self.client.get('/standin/api/plan/', params)
+		self.assertEqual(response.status_code, 200)
+		return json.loads(response.content.decode('utf-8'))
+
+	def test_compact_plan(self):
+		data = self.get()
+		self.assertEqual(sorted(t[0] for t in data['t']), ['T0', 'T1', 'T2'])
+		self.assertEqual([g[0] for g in data['g']], ['10A', '10B'])
+		day = data['days'][0]
+		self.assertEqual(day['d'], '2016-01-25')
+		entries = [e for grade in day['g'] for e in grade[1]]
+		self.assertEqual(len(entries), 15)
+		self.assertEqual(data['t'][entries[1]['st']][0], 'T0')
+		self.assertEqual(entries[0]['f'], ['free'])
+		self.assertNotIn('n', entries[0])
+
+	def test_filters(self):
+		data = self.get(grade='10B')
+		self.assertEqual([data['g'][grade[0]][0] for grade in data['days'][0]['g']], ['10B'])
+		self.assertEqual(self.client.get('/standin/api/plan/', {'teacher': 'T0'}).status_code, 403)
+		self.client.force_login(get_user_model().objects.create(username='admin', is_staff=True))
+		data = self.get(teacher='T0', grade='10A')
+		self.assertEqual([e['h'] for e in data['days'][0]['g'][0][1]], [[1, 1], [2, 2], [4, 4], [7, 7], [10, 10]])
+
+	def test_own_teacher_plan(self):
+		user = get_user_model().objects.create(username='t1')
+		Teacher.objects.filter(code='T1').update(user=user)
+		self.client.force_login(user)
+		self.assertEqual(self.client.get('/standin/api/plan/', {'teacher': 'T0'}).status_code, 403)
+		self.assertEqual(self.client.get('/standin/api/plan/', {'teacher': 'T9'}).status_code, 403)
+		data = self.get(teacher='T1')
+		self.assertEqual([data['t'][e['t']][0] for grade in data['days'][0]['g'] for e in grade[1]], ['T1'] * 5)
+
+	def test_grouped_entries(self):
+		export = davinciExport(teachers=3, classes=1, lessons=4, stamp='20160125 0930')
+		# lessons 0-2 are the same lesson in consecutive hours.
+		for lesson in export['result']['displaySchedule']['lessonTimes'][1:3]:
+			lesson.update(teacherCodes=['T0'], courseRef=export['result']['courses'][0]['id'], roomCodes=['R0'])
+		self.parse(export)
+		entries = self.get()['days'][0]['g'][0][1]
+		self.assertEqual([e['h'] for e in entries], [[1, 3], [4, 4]])
+		self.assertNotIn('sh', entries[0])
+
+	def test_etag_and_gzip(self):
+		response = self.client.get('/standin/api/plan/', HTTP_ACCEPT_ENCODING='gzip')
+		self.assertEqual(response['Content-Encoding'], 'gzip')
+		response = self.client.get('/standin/api/plan/', HTTP_IF_NONE_MATCH=response['ETag'])
+		self.assertEqual(response.status_code, 304)
+
+class ConditionalGetTest(ParserTestCase):
+
+	def test_not_modified(self):
+		export = davinciExport()
+		self.parse(export)
+		response = self.client.get('/standin/')
+		etag = response['ETag']
+		self.assertFalse(etag.startswith('W/'))
+		self.assertIn('Last-Modified', response)
+
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.get('/standin/', HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(response.status_code, 304)
+		self.assertEqual(len(queries), 0)
+
+		# even an upload without changes updates the time stamp.
+		export['about']['serverTimeStamp'] = '20160125 0800'
+		self.parse(export)
+		response = self.client.get('/standin/', HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(response.status_code, 200)
+
+	def test_day_and_language(self):
+		self.parse(davinciExport())
+		plan = registry.getActivePlan()
+		etag = self.client.get('/standin/')['ETag']
+		key = cache.makeKey('pupil-html', plan, 2, None)
+		# at midnight, other days are shown.
+		with mock.patch.object(Plan, 'getStartDate', return_value=datetime.date(2016, 1, 26)):
+			self.assertEqual(self.client.get('/standin/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+			self.assertNotEqual(cache.makeKey('pupil-html', plan, 2, None), key)
+			self.assertNotContains(self.client.get('/standin/'), 'standin_20160125')
+		with translation.override('de'):
+			self.assertNotEqual(cache.makeKey('pupil-html', plan, 2, None), key)
+			self.assertNotEqual(views.planETag(None), etag.strip('"'))
+
+class PlanItererBenchmark(TestCase):
+
+	class Key:
+		"""Grade id which counts how often it is compared."""
+
+		comparisons = 0
+
+		def __init__(self, value):
+			self.value = value
+
+		def __hash__(self):
+			return hash(self.value)
+
+		def __eq__(self, other):
+			PlanItererBenchmark.Key.comparisons += 1
+			return self.value == other.value
+
+	class Entry:
+		def __init__(self, day, grade):
+			self.day = day
+			self.grade = self.grade_id = PlanItererBenchmark.Key(grade)
+
+	def build(self, entries, grades):
+		"""Returns the plan and the number of grade comparisons needed to build it."""
+		days = [datetime.date(2016, 1, 25) + datetime.timedelta(days=i) for i in range(2)]
+		rows = [self.Entry(days[i % 2], i % grades) for i in range(entries)]
+		self.Key.comparisons = 0
+		plan = PlanIterer()
+		for d in days:
+			plan.addDay(d)
+		for r in rows:
+			plan.addEntry(r)
+		return plan, self.Key.comparisons
+
+	def test_bucketing(self):
+		plan, _ = self.build(12000, 120)
+		days = list(plan)
+		self.assertEqual(len(days), 2)
+		self.assertEqual([g.grade.value for g in days[0]][:3], [0, 2, 4])
+		self.assertEqual(sum(len(list(g)) for d in days for g in d), 12000)
+
+	def test_cost_does_not_depend_on_grades(self):
+		# every entry is compared at most with its own grade (no scan over all grades).
+		self.assertLessEqual(self.build(12000, 1)[1], 12000)
+		self.assertLessEqual(self.build(12000, 120)[1], 12000)
+
+class GroupingTest(ParserTestCase):
+
+	def test_consecutive_hours_are_grouped(self):
+		export = davinciExport(teachers=1, lessons=6)
+		lessons = export['result']['displaySchedule']['lessonTimes']
+		for les in lessons:
+			les['roomCodes'] = ['R1']
+		lessons[4]['changes'] = {'cancelled': 'lessonCancelled', 'information': 'Exam'}
+		parser = self.parse(export)
+		entries = [e for day in parser.plan.getPupilPlan() for grade in day for e in grade]
+		self.assertEqual([e.getHour() for e in entries], ['1.-4.', '5.', '6.'])
+		self.assertEqual(entries[0].hour, 4)
+		self.assertEqual(entries[0].room, 'R1')
+		self.assertTrue(entries[0].isFree)
+		ungrouped = [e for day in parser.plan.getPupilPlan(group=False) for grade in day for e in grade]
+		self.assertEqual(len(ungrouped), 6)
+
+class PlanRowTest(ParserTestCase):
+
+	def test_rows_share_references(self):
+		export = davinciExport(teachers=2, lessons=8)
+		export['result']['displaySchedule']['lessonTimes'][1]['changes'] = {'newTeacherCodes': ['T0']}
+		parser = self.parse(export)
+		days = parser.plan.getNextDays()
+		rows = parser.plan.getPupilRows(days)
+		self.assertEqual(len(rows), 8)
+		self.assertTrue(all(isinstance(r, PlanRow) for r in rows))
+		self.assertIs(rows[0].course.teacher, rows[1].supplyTeacher)
+		self.assertIs(rows[0].grade, rows[1].grade)
+		self.assertEqual(rows[0].grade.division.name, 'Berufsschule')
+		self.assertTrue(rows[0].isFree)
+		self.assertEqual(rows[0].course.subject.dspName, 'S0')
+
+	def test_display_names(self):
+		parser = self.parse(davinciExport(teachers=1, lessons=1))
+		user = get_user_model().objects.create(username='t0', first_name='Linked', last_name='User')
+		teacher = Teacher.objects.get(code='T0')
+		teacher.user = user
+		teacher.save()
+		self.assertEqual(Teacher.objects.get(code='T0').teacherName, 'Linked User (T0)')
+		with mock.patch.object(app_settings, 'PLAN_PUPIL_TEACHER_FULLNAME', True), \
+			mock.patch.object(app_settings, 'PLAN_PUPIL_TEACHER_SHORTCUT', True):
+			app_settings.invalidate()
+			refreshAllDisplayNames()
+		app_settings.invalidate()
+		with CaptureQueriesContext(connection) as queries:
+			rows = parser.plan.getPupilRows(parser.plan.getNextDays())
+		self.assertEqual(len(queries), 1)
+		self.assertEqual(rows[0].course.teacher.dspName, 'Linked User (T0)')
+
+		# renaming the user updates the stored name.
+		user.first_name = 'Renamed'
+		user.save()
+		self.assertEqual(Teacher.objects.get(code='T0').teacherName, 'Renamed User (T0)')
+
+		# a login does not look for a linked teacher.
+		with CaptureQueriesContext(connection) as queries:
+			user.save(update_fields=['last_login'])
+		self.assertEqual(len(queries), 1)
+
+	@mock.patch('standin.models.transaction.on_commit', lambda func: func())
+	def test_changed_names_invalidate_cache(self):
+		self.parse(davinciExport(teachers=1, lessons=1))
+		self.assertContains(self.client.get('/standin/'), 'T0')
+		generation = cache.getGeneration()
+		teacher = Teacher.objects.get(code='T0')
+		teacher.save()
+		self.assertEqual(cache.getGeneration(), generation)
+
+		# e.g. edited in the admin.
+		teacher.code = 'X0'
+		teacher.save()
+		self.assertNotEqual(cache.getGeneration(), generation)
+		self.assertContains(self.client.get('/standin/'), 'X0')
+
+	def test_sync_stores_display_names(self):
+		with mock.patch.object(app_settings, 'PLAN_PUPIL_SUBJECT_FULLNAME', True):
+			self.parse(davinciExport(lessons=1))
+		subject = Subject.objects.get(code='S0')
+		self.assertEqual(subject.pupilName, 'Subject 0')
+		self.assertEqual(subject.teacherName, 'Subject 0 (S0)')
+
+@mock.patch.object(app_settings, 'PLAN_INGEST_MODE', 'command')
+class IngestQueueTest(ParserTestCase):
+
+	def setUp(self):
+		super().setUp()
+		app_settings.invalidate()
+		self.media = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.media)
+		override = override_settings(MEDIA_ROOT=self.media)
+		override.enable()
+		self.addCleanup(override.disable)
+		self.addCleanup(app_settings.invalidate)
+
+	def upload(self, export, name='plan.json.gz'):
+		return ingest.enqueue(SimpleUploadedFile(name, gzip.compress(json.dumps(export).encode('utf-8'))))
+
+	def test_newest_upload_wins(self):
+		old = self.upload(davinciExport(lessons=2, stamp='20160125 0700'))
+		new = self.upload(davinciExport(lessons=3, stamp='20160125 0800'))
+		self.assertEqual(Plan.objects.count(), 0)
+		self.assertEqual(ingest.processJobs(), 1)
+
+		old.refresh_from_db()
+		new.refresh_from_db()
+		self.assertEqual(old.status, PlanJob.SKIPPED)
+		self.assertEqual(new.status, PlanJob.DONE)
+		self.assertEqual(new.progress, 100)
+		self.assertIsNotNone(new.getDuration())
+		self.assertEqual(PlanEntry.objects.filter(header=new.plan).count(), 3)
+		self.assertEqual(Plan.objects.count(), 1)
+
+	def test_failed_upload(self):
+		export = davinciExport(lessons=2)
+		export['result']['displaySchedule']['lessonTimes'][1]['courseRef'] = str(uuid.uuid4())
+		job = self.upload(export)
+		call_command('standin_ingest', once=True, stdout=io.StringIO())
+		job.refresh_from_db()
+		self.assertEqual(job.status, PlanJob.FAILED)
+		self.assertIn('Unknown course', job.error)
+		self.assertEqual(job.stage, 'changes')
+		self.assertEqual(Plan.objects.count(), 0)
+
+	def test_job_of_dead_worker_is_failed(self):
+		stale = self.upload(davinciExport(lessons=2, stamp='20160125 0700'))
+		self.assertEqual(ingest.claimJob(), stale)
+		new = self.upload(davinciExport(lessons=3, stamp='20160125 0800'))
+		# the worker is still alive.
+		heartbeat = ingest.Heartbeat(stale)
+		heartbeat.stage = 'changes'
+		heartbeat.beat()
+		self.assertEqual(ingest.processJobs(), 0)
+		self.assertEqual(ingest.getProgress(PlanJob.objects.get(pk=stale.pk))[0], 'changes')
+
+		# the worker died.
+		PlanJob.objects.filter(pk=stale.pk).update(heartbeat=timezone.now() - datetime.timedelta(minutes=10))
+		self.assertEqual(ingest.processJobs(), 1)
+		stale.refresh_from_db()
+		new.refresh_from_db()
+		self.assertEqual(stale.status, PlanJob.FAILED)
+		self.assertEqual(new.status, PlanJob.DONE)
+
+class DropFolderTest(ParserTestCase):
+
+	def setUp(self):
+		super().setUp()
+		self.path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.path)
+		media = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, media)
+		override = override_settings(MEDIA_ROOT=media)
+		override.enable()
+		self.addCleanup(override.disable)
+
+	def write(self, name, export, mtime=None):
+		path = os.path.join(self.path, name)
+		with open(path, 'wb') as f:
+			f.write(json.dumps(export).encode('utf-8'))
+		if mtime is not None:
+			os.utime(path, (mtime, mtime))
+
+	def watcher(self, workers=0):
+		return DropFolderWatcher(self.path, workers=workers, settle=0, interval=0, useInotify=False)
+
+	def test_files_are_imported_once(self):
+		export = davinciExport(lessons=2)
+		self.write('a.json', export)
+		self.write('b.json', export)
+		self.write('c.json.part', export)
+		with self.assertLogs('standin.watch', 'INFO') as logs:
+			self.watcher().run(once=True)
+		self.assertEqual(Plan.objects.count(), 1)
+		self.assertEqual(len([l for l in logs.output if 'plan queued' in l]), 1)
+		self.assertEqual(len([l for l in logs.output if 'reason=duplicate' in l]), 1)
+
+		# the hashes are kept in the database (e.g. for a restarted watcher).
+		with self.assertLogs('standin.watch', 'INFO') as logs:
+			self.watcher().run(once=True)
+		self.assertEqual(len([l for l in logs.output if 'reason=duplicate' in l]), 2)
+		self.assertEqual(PlanJob.objects.count(), 1)
+
+	def test_files_are_queued_in_the_order_they_were_written(self):
+		# hashed in parallel, but the newest export wins.
+		self.write('new.json', davinciExport(lessons=3, stamp='20160125 0800'), mtime=2000)
+		self.write('old.json', davinciExport(lessons=2, stamp='20160125 0700'), mtime=1000)
+		self.watcher(workers=2).run(once=True)
+		self.assertEqual(
+			list(PlanJob.objects.order_by('id').values_list('name', 'status')),
+			[('old.json', PlanJob.SKIPPED), ('new.json', PlanJob.DONE)]
+		)
+		self.assertEqual(Plan.objects.get().entries.count(), 3)
+
+	@mock.patch.object(app_settings, 'PLAN_INGEST_MODE', 'command')
+	def test_files_are_left_to_the_ingest_command(self):
+		app_settings.invalidate()
+		self.addCleanup(app_settings.invalidate)
+		self.write('plan.json', davinciExport(lessons=2))
+		self.watcher().run(once=True)
+		self.assertEqual(PlanJob.objects.get().status, PlanJob.QUEUED)
+		self.assertEqual(Plan.objects.count(), 0)
+
+	def test_files_are_imported_after_they_settled(self):
+		self.write('plan.json', davinciExport(lessons=2))
+		watcher = self.watcher()
+		self.assertEqual(watcher.scan(), [])
+		self.write('plan.json', davinciExport(lessons=3))
+		os.utime(os.path.join(self.path, 'plan.json'), (0, 0))
+		self.assertEqual(watcher.scan(), [])
+		self.assertEqual(watcher.scan(), [os.path.join(self.path, 'plan.json')])
@@ -23,4 +23,6 @@ from . import views
 urlpatterns = [
 	url(r'^$', views.pupil, name='pupil'),
 	url(r'^teacher/$', views.teacher, name='teacher'),
+	url(r'^grade/(?P<code>[^/]+)/$', views.grade, name='grade'),
+	url(r'^api/plan/$', views.planApi, name='api_plan'),
 ]
@@ -17,23 +17,145 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.shortcuts import render
-from django.http import HttpResponse
-from standin.models import Plan
+from django.contrib.auth.decorators import login_required
+from django.http import Http404, HttpResponse, JsonResponse
+from django.template.loader import render_to_string
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition
+from standin.helpers import PlanIterer
+from standin.models import Teacher
+from standin import api, cache, registry
+from standin import settings as app_settings
+import hashlib
+import logging
 
+logger = logging.getLogger(__name__)
+
+def getPlanVersion(request):
+	"""Returns id and dates of the active plan (or None), see registry.getPlanVersion."""
+	return registry.getPlanVersion()
+
+def planETag(request, *args, **kwargs):
+	"""Strong ETag of the current plan (including everything changing the output)."""
+	version = getPlanVersion(request)
+	if version is None:
+		return None
+
+	parts = (
+		version['id'], version['vpstand'].isoformat(), version['vpdtup'].isoformat(),
+		cache.getGeneration(), cache.getVariant(), args, sorted(kwargs.items())
+	)
+	return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+def userPlanETag(request, *args, **kwargs):
+	"""Same as planETag, but for pages which depend on the logged in user."""
+	etag = planETag(request, *args, **kwargs)
+	if etag is None:
+		return None
+	return '%s-%s' % (etag, request.user.pk)
+
+def planLastModified(request, *args, **kwargs):
+	"""Date of the last upload (or changes of delta uploads) of the current plan."""
+	version = getPlanVersion(request)
+	if version is None:
+		return None
+	if version['changed'] is not None and version['changed'] > version['vpdtup']:
+		return version['changed']
+	return version['vpdtup']
+
+def renderPlan(plan, planEntries, request=None):
+	"""Renders the pupil plan (or the plan of a class). The page does not depend on the
+	request, so it is rendered without one when the cache is prewarmed."""
+	return render_to_string('standin/pupil.html', {'plan': plan, 'planEntries': planEntries}, request)
+
+@condition(etag_func=planETag, last_modified_func=planLastModified)
 def pupil(request):
-	plan = Plan.objects.latest()
+	plan = registry.getActivePlan()
+	render = lambda pupilPlan: renderPlan(plan, pupilPlan, request)
+	with app_settings.countLookups() as lookups:
+		if plan is not None:
+			content = cache.getRenderedPupilPlan(plan, render)
+		else:
+			content = render([])
+	logger.debug('Rendered pupil plan with %d preference lookups.', lookups.count)
+	return HttpResponse(content)
+
+@condition(etag_func=planETag, last_modified_func=planLastModified)
+def grade(request, code):
+	plan = registry.getActivePlan()
+	render = lambda gradePlan: renderPlan(plan, gradePlan, request)
 	if plan is not None:
-		pupilPlan = plan.getPupilPlan()
+		if code not in cache.getGradeCodes(plan):
+			raise Http404('Unknown class')
+		content = cache.getRenderedGradePlan(plan, code, render)
 	else:
-		pupilPlan = []
-	context = {
-		'plan': plan,
-		'planEntries': pupilPlan,
-	}
-	return HttpResponse(render(request, 'standin/pupil.html', context))
+		content = render([])
+	return HttpResponse(content)
 
+def apiETag(request):
+	"""ETag of the JSON plan (depends on the filters and, for teacher plans, the user)."""
+	teacher = request.GET.get('teacher')
+	etag = userPlanETag if teacher is not None else planETag
+	return etag(request, request.GET.get('grade'), teacher)
+
+def getApiPlan(plan, grade, teacher):
+	"""Returns the (grouped) entries for the JSON plan, filtered by class and teacher."""
+	if teacher is None:
+		if grade is None:
+			return cache.getPupilPlan(plan)
+		return cache.getGradePlan(plan, grade)
+
+	teacherPlan = cache.getTeacherPlan(plan, teacher)
+	if grade is None:
+		return teacherPlan
+	gradePlan = teacherPlan.partition().get(grade)
+	if gradePlan is None:
+		gradePlan = PlanIterer.fromDays(teacherPlan.getDays())
+	return gradePlan
+
+@gzip_page
+@condition(etag_func=apiETag, last_modified_func=planLastModified)
+def planApi(request):
+	"""Returns the active plan as JSON (see api.PlanSerializer), filtered by ?grade=<code> and ?teacher=<code>."""
+	plan = registry.getActivePlan()
+	if plan is None:
+		return JsonResponse({'error': 'No plan available.'}, status=404)
+
+	grade = request.GET.get('grade')
+	teacher = request.GET.get('teacher')
+	if teacher is not None:
+		# the plan of a teacher contains more than the pupil plan.
+		if not request.user.is_authenticated():
+			return JsonResponse({'error': 'Login required.'}, status=403)
+		teachers = Teacher.objects.filter(code=teacher)
+		if not request.user.is_staff:
+			# only the own plan, except for staff.
+			teacher = teachers.filter(user=request.user).first()
+			if teacher is None:
+				return JsonResponse({'error': 'Permission denied.'}, status=403)
+		else:
+			teacher = teachers.first()
+			if teacher is None:
+				return JsonResponse({'error': 'Unknown teacher.'}, status=404)
+
+	filters = ['grade:%s' % (grade,), 'teacher:%s' % (getattr(teacher, 'pk', None),)]
+	content = cache.cached(
+		cache.makeKey('api', plan, 2, filters),
+		lambda: api.dumps(api.PlanSerializer().serialize(plan, getApiPlan(plan, grade, teacher)))
+	)
+	return HttpResponse(content, content_type='application/json; charset=utf-8')
+
+@login_required
+@condition(etag_func=userPlanETag, last_modified_func=planLastModified)
 def teacher(request):
-	context = {}
-	return HttpResponse(render(request, 'standin/teacher.html', context))
+	plan = registry.getActivePlan()
+	teacher = Teacher.objects.filter(user=request.user).first()
+	renderPlan = lambda teacherPlan: render_to_string(
+		'standin/teacher.html', {'plan': plan, 'teacher': teacher, 'planEntries': teacherPlan}, request
+	)
+	if plan is not None and teacher is not None:
+		content = cache.getRenderedTeacherPlan(plan, teacher, renderPlan)
+	else:
+		content = renderPlan([])
+	return HttpResponse(content)
 
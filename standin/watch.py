@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# vim: fenc=utf-8:ts=8:sw=8:si:sta:noet
+#
+# Standin plan as extension to Django framework.
+# Copyright (C) 2016 Friedrich-List-Schule Wiesbaden
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the 
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor
+from django.core.files import File
+from standin import settings as app_settings
+from standin import ingest
+from standin.models import PlanJob
+import hashlib, logging, os, time
+
+# inotify is optional. Without it, the directory is polled.
+try:
+	from inotify_simple import INotify, flags
+except ImportError:
+	INotify = None
+
+logger = logging.getLogger(__name__)
+
+class DropFolderWatcher:
+	"""Imports plan files written to a directory (e.g. by the DaVinci server).
+
+	A file is imported once its size and modification time did not change
+	for `settle` seconds (so partially written files are not read). Up to
+	`workers` files are hashed at the same time (with 0 workers, by the
+	watching thread itself). The files are queued like uploads of the admin
+	(see standin.ingest) in the order they were written, so they are never
+	parsed at the same time. Files with the content of an already queued
+	file are skipped (the hash is stored with the job).
+
+	Unless the queue is processed by standin_ingest (PLAN_INGEST_MODE is
+	'command'), the watcher parses the queued files itself.
+	"""
+
+	SUFFIXES = ('.json', '.json.gz')
+
+	def __init__(self, path, workers=1, settle=2.0, interval=5.0, remove=False, useInotify=True):
+		self.path = path
+		self.settle = settle
+		self.interval = interval
+		self.remove = remove
+		# path -> (size, mtime, time of observation) of files not yet imported.
+		self.pending = {}
+		# path -> (size, mtime) of handled files (ignored until they change).
+		self.handled = {}
+		self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+		self._inotify = None
+		if useInotify and INotify is not None:
+			self._inotify = INotify()
+			self._inotify.add_watch(path, flags.CLOSE_WRITE | flags.MOVED_TO | flags.MODIFY)
+
+	def isPlanFile(self, name):
+		return not name.startswith('.') and name.endswith(self.SUFFIXES)
+
+	def scan(self):
+		"""Looks for new or changed files. Returns the paths ready to be imported."""
+		now = time.time()
+		ready = []
+		present = set()
+		for entry in os.scandir(self.path):
+			if not entry.is_file() or not self.isPlanFile(entry.name):
+				continue
+			present.add(entry.path)
+			stat = entry.stat()
+			current = (stat.st_size, stat.st_mtime)
+			if self.handled.get(entry.path) == current:
+				continue
+			seen = self.pending.get(entry.path)
+			if seen is None or seen[:2] != current:
+				# new or still written, wait until it settled.
+				self.pending[entry.path] = current + (now,)
+			elif now - seen[2] >= self.settle:
+				del self.pending[entry.path]
+				ready.append((stat.st_mtime, entry.path))
+
+		# forget the files which were removed meanwhile.
+		for known in (self.pending, self.handled):
+			for path in set(known) - present:
+				del known[path]
+
+		# files of the same scan are imported in the order they were written.
+		return [path for mtime, path in sorted(ready)]
+
+	def wait(self):
+		"""Waits for changes in the directory (or until the next scan is due)."""
+		timeout = self.interval
+		if len(self.pending) > 0:
+			timeout = min(timeout, self.settle)
+		if self._inotify is not None:
+			self._inotify.read(timeout=int(timeout * 1000))
+		else:
+			time.sleep(timeout)
+
+	def hashFile(self, path):
+		"""Returns the SHA-1 of the file (or None if it cannot be read)."""
+		try:
+			digest = hashlib.sha1()
+			with open(path, 'rb') as f:
+				for chunk in iter(lambda: f.read(65536), b''):
+					digest.update(chunk)
+			return digest.hexdigest()
+		except OSError:
+			logger.exception('plan failed file=%s', path)
+			return None
+
+	def importFiles(self, paths):
+		"""Hashes the given files (in parallel) and queues them in the given order.
+
+		Returns the number of queued files.
+		"""
+		if self._executor is None:
+			digests = map(self.hashFile, paths)
+		else:
+			digests = self._executor.map(self.hashFile, paths)
+
+		queued = 0
+		for path, digest in zip(paths, digests):
+			if digest is not None and self.queueFile(path, digest):
+				queued += 1
+		if queued > 0 and app_settings.snapshot().PLAN_INGEST_MODE != 'command':
+			ingest.processJobs()
+		return queued
+
+	def queueFile(self, path, digest):
+		"""Queues a single file (unless it is a duplicate). Returns True if it was queued."""
+		job = None
+		try:
+			if PlanJob.objects.filter(digest=digest).exclude(status=PlanJob.FAILED).exists():
+				logger.info('plan skipped file=%s sha1=%s reason=duplicate', path, digest)
+			else:
+				with open(path, 'rb') as f:
+					job = ingest.enqueue(File(f, name=os.path.basename(path)), digest=digest, start=False)
+				logger.info('plan queued file=%s sha1=%s bytes=%d job=%d', path, digest, job.planFile.size, job.pk)
+			if self.remove:
+				os.remove(path)
+		except Exception:
+			logger.exception('plan failed file=%s', path)
+		finally:
+			# unless it changes, the file is not imported again (even if it failed).
+			if os.path.exists(path):
+				stat = os.stat(path)
+				self.handled[path] = (stat.st_size, stat.st_mtime)
+		return job is not None
+
+	def run(self, once=False):
+		"""Watches the directory. With once, returns after all present files are imported."""
+		logger.info(
+			'watching path=%s inotify=%s settle=%.1f interval=%.1f', self.path,
+			self._inotify is not None, self.settle, self.interval
+		)
+		try:
+			while True:
+				ready = self.scan()
+				if len(ready) > 0:
+					self.importFiles(ready)
+				if once and len(self.pending) == 0:
+					break
+				self.wait()
+		finally:
+			if self._executor is not None:
+				self._executor.shutdown(wait=True)
+			if self._inotify is not None:
+				self._inotify.close()